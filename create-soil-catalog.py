@@ -0,0 +1,75 @@
+#!/usr/bin/python
+# -*- coding: UTF-8
+
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/. */
+
+# Authors:
+# Michael Berg-Mohnicke <michael.berg@zalf.de>
+#
+# Maintainers:
+# Currently maintained by the authors.
+#
+# This file has been created at the Institute of
+# Landscape Systems Analysis at the ZALF.
+# Copyright (C: Leibniz Centre for Agricultural Landscape Research (ZALF)
+
+import sys
+import time
+
+import shared
+
+PATHS = {
+    "mbm-local-remote": {
+        "path-to-soil-dir": "/home/berg/Desktop/soil/",
+        "path-to-data-dir": "./data/",
+    },
+    "hpc-local-remote": {
+        "path-to-soil-dir": "/beegfs/common/data/soil/global_soil_dataset_for_earth_system_modeling/",
+        "path-to-data-dir": "./data/",
+    },
+    "remoteProducer-remoteMonica": {
+        "path-to-soil-dir": "/project/soil/global_soil_dataset_for_earth_system_modeling/",
+        "path-to-data-dir": "./data/",
+    }
+}
+
+
+def create_soil_catalog():
+    """write the soil catalog of a region, the producers pick it up from the data dir"""
+
+    config = {
+        "mode": "mbm-local-remote",
+        "region": "africa",
+        "resolution": "5min",
+        "path_to_catalog": None,
+    }
+
+    shared.update_config(config, sys.argv, print_config=True, allow_new_keys=False)
+
+    paths = PATHS[config["mode"]]
+
+    s_resolution = {"5min": 5 / 60., "30sec": 30 / 3600.}[config["resolution"]]
+    s_res_scale_factor = {"5min": 60., "30sec": 3600.}[config["resolution"]]
+    s_lat_0 = shared.REGION_TO_LAT_LON_BOUNDS["earth"][config["resolution"]]["tl"]["lat"]
+    s_lon_0 = shared.REGION_TO_LAT_LON_BOUNDS["earth"][config["resolution"]]["tl"]["lon"]
+    lat_lon_bounds = shared.REGION_TO_LAT_LON_BOUNDS[config["region"]]
+
+    lats, lons = shared.bounding_box_lats_lons(lat_lon_bounds, s_resolution, s_res_scale_factor)
+    s_row_0 = int((s_lat_0 - lats[0]) / s_resolution)
+    s_row_n = int((s_lat_0 - lats[-1]) / s_resolution)
+    s_col_0 = int((lons[0] - s_lon_0) / s_resolution)
+    s_col_n = int((lons[-1] - s_lon_0) / s_resolution)
+
+    path_to_catalog = config["path_to_catalog"] or \
+        shared.soil_catalog_path(paths["path-to-data-dir"], config["region"], config["resolution"])
+
+    start_time = time.perf_counter()
+    global_soil_dataset = shared.GlobalSoilDataSet(paths["path-to-soil-dir"], config["resolution"])
+    global_soil_dataset.build_catalog(path_to_catalog, s_row_0, s_col_0, s_row_n - s_row_0 + 1, s_col_n - s_col_0 + 1)
+    print("building soil catalog took ", (time.perf_counter() - start_time), " seconds")
+
+
+if __name__ == "__main__":
+    create_soil_catalog()
@@ -0,0 +1,60 @@
+#!/usr/bin/python
+# -*- coding: UTF-8
+
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/. */
+
+# Authors:
+# Michael Berg-Mohnicke <michael.berg@zalf.de>
+#
+# Maintainers:
+# Currently maintained by the authors.
+#
+# This file has been created at the Institute of
+# Landscape Systems Analysis at the ZALF.
+# Copyright (C: Leibniz Centre for Agricultural Landscape Research (ZALF)
+
+
+import sys
+import threading
+import time
+import zmq
+
+import shared
+
+
+def run_monica_stand_in():
+    """relay the envs of a producer to a consumer like the proxies and MONICAs of start_monicas.sh, but offline"""
+
+    config = {
+        "in-port": "6666",  # the producers connect here, as to the frontend of the input proxy
+        "out-port": "7777",  # the consumers connect here, as to the backend of the output proxy
+        "latency_ms": "0",  # time a MONICA takes per env
+        "workers": "1",  # number of envs worked on at once
+        "start_year": "1980",
+        "years": "30",  # years of results per env
+        "summary_interval": "10",  # seconds between the summary lines
+    }
+
+    shared.update_config(config, sys.argv, print_config=True, allow_new_keys=False)
+
+    context = zmq.Context()
+    in_socket = context.socket(zmq.PULL)
+    in_socket.bind("tcp://*:" + config["in-port"])
+    out_socket = context.socket(zmq.PUSH)
+    out_socket.bind("tcp://*:" + config["out-port"])
+
+    stand_in = shared.MonicaStandIn(in_socket, out_socket, float(config["latency_ms"]), int(config["workers"]),
+                                    int(config["start_year"]), int(config["years"]))
+    threading.Thread(target=stand_in.run, daemon=True).start()
+    try:
+        while True:
+            time.sleep(float(config["summary_interval"]))
+            print("monica stand-in: ", stand_in.report())
+    except KeyboardInterrupt:
+        print("monica stand-in: ", stand_in.report())
+
+
+if __name__ == "__main__":
+    run_monica_stand_in()
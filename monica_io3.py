@@ -652,11 +652,17 @@ def create_env_json_from_json_config(crop_site_sim):
 def add_climate_data_to_env(env, simj, climate_csv_string=""):
     "add climate data separately to env"
 
-    #if not climate_csv_string:
-    #    with open(simj["climate.csv"]) as _:
-    #        climate_csv_string = _.read()
+    # the csv reading of the producers (inline_climate), without monica_python
+    import shared
 
-    #if climate_csv_string:
-    #    env["climateData"] = json.loads(monica_python.readClimateDataFromCSVStringViaHeadersToJsonString(climate_csv_string, json.dumps(simj["climate.csv-options"])))
+    csv_options = simj["climate.csv-options"]
+    if climate_csv_string:
+        dates, data = shared.read_climate_csv(climate_csv_string.splitlines(), csv_options)
+    else:
+        dates, data = shared.read_climate_csv_files(simj["climate.csv"], csv_options)
+
+    env["climateData"] = shared.climate_data_to_json(dates, data, csv_options.get("start-date"),
+                                                     csv_options.get("end-date"))
+    env["pathToClimateCSV"] = ""
 
     return env
@@ -15,6 +15,8 @@ import math
 import sys
 import errno
 
+import shared
+
 # read folder
 
 PATHS = {
@@ -87,15 +89,20 @@ def main():
 def readFilesPerDecade(crop, type, roundToDecimal, yearRange, indexOffset, sourcepath, stdFolder, avgFolder):
     # read files per decade
     files = []
-    index = indexOffset
-    for year in range(yearRange[0], yearRange[1] + 1):
-        file = fileTemplateInput.format(crop, type, year, index)
-        index += 1
-        # join path and file
-        file = os.path.join(sourcepath, file)
-
-        grid = readFile(file)
-        files.append(grid)
+    if sourcepath.endswith(".nc"):
+        # the source is the cube of a setup (grid_backend=netcdf of the consumers), read just this decade
+        files, header = readCubePerDecade(sourcepath, crop, type, yearRange, indexOffset)
+    else:
+        index = indexOffset
+        for year in range(yearRange[0], yearRange[1] + 1):
+            file = fileTemplateInput.format(crop, type, year, index)
+            index += 1
+            # join path and file
+            file = os.path.join(sourcepath, file)
+
+            grid = readFile(file)
+            files.append(grid)
+        header = readAsciiHeader(file)
     # calculate average
     avg = np.nanmean(files, axis=0)
     # calculate standard deviation
@@ -114,13 +121,13 @@ def readFilesPerDecade(crop, type, roundToDecimal, yearRange, indexOffset, sourc
     fileAvg = os.path.join(avgFolder, fileAvg)
     # writeAsciiHeader(fileAvg, readAsciiHeader(file))
     # write file with acuracy of 0 decimals (int)
-    np.savetxt(fileAvg, avg, fmt=fmtStr, delimiter=' ', newline='\n', header=asciiHeaderString(readAsciiHeader(file)),
+    np.savetxt(fileAvg, avg, fmt=fmtStr, delimiter=' ', newline='\n', header=asciiHeaderString(header),
                footer='', comments='# ', encoding=None)
     fileStd = fileTemplateOutStd.format(crop, type, yearRange[0], yearRange[1])
     fileStd = os.path.join(stdFolder, fileStd)
     # writeAsciiHeader(fileStd, readAsciiHeader(file))
 
-    np.savetxt(fileStd, std, fmt=fmtStr, delimiter=' ', newline='\n', header=asciiHeaderString(readAsciiHeader(file)),
+    np.savetxt(fileStd, std, fmt=fmtStr, delimiter=' ', newline='\n', header=asciiHeaderString(header),
                footer='', comments='# ', encoding=None)
 
 
@@ -135,6 +142,22 @@ def readFile(file):
     return ascii_data_array
 
 
+def readCubePerDecade(cube_path, crop, type, yearRange, indexOffset):
+    # the time steps of the .asc files readFilesPerDecade reads, the crop with the cm_counts from indexOffset on
+    print("Cube:", cube_path, crop, type, yearRange)
+    cube = shared.read_cube(cube_path, keys=[type], years=yearRange, crops=[crop],
+                            cm_counts=(indexOffset, indexOffset + yearRange[1] - yearRange[0]))
+    grids = cube["grids"][0]
+    grids[grids == 0] = np.nan
+    h = cube["header"]
+    image_extent = [
+        h["xllcorner"], h["xllcorner"] + h["ncols"] * h["cellsize"],
+        h["yllcorner"], h["yllcorner"] + h["nrows"] * h["cellsize"]]
+    header = AsciiHeader(cube_path, h["ncols"], h["nrows"], h["xllcorner"], h["yllcorner"], h["cellsize"], NONEVALUE,
+                         image_extent)
+    return list(grids), header
+
+
 def makeDir(dir):
     if not os.path.exists(dir):
         try:
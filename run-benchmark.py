@@ -0,0 +1,139 @@
+#!/usr/bin/python
+# -*- coding: UTF-8
+
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/. */
+
+# Authors:
+# Michael Berg-Mohnicke <michael.berg@zalf.de>
+#
+# Maintainers:
+# Currently maintained by the authors.
+#
+# This file has been created at the Institute of
+# Landscape Systems Analysis at the ZALF.
+# Copyright (C: Leibniz Centre for Agricultural Landscape Research (ZALF)
+
+
+import json
+import subprocess as sp
+import sys
+import threading
+import time
+import zmq
+
+import shared
+
+
+def run_benchmark():
+    """run a producer and a consumer against the MONICA stand-in and report the throughput,
+    the bytes per env and the backlog of the consumer"""
+
+    config = {
+        "run": "africa",  # africa|nigeria, which producer and consumer to run
+        "region": "",  # if set, passed on to the producer
+        "run-setups": "[1]",
+        "producer_args": "",  # more key=value args for the producer, separated by ;
+        "consumer_args": "",  # more key=value args for the consumer, separated by ;
+        "in-port": "6666",
+        "out-port": "7777",
+        "feedback-port": "7789",  # the consumer reports its backlog here
+        "flow_control": False,  # let the producer pace the envs by the reports of the consumer too
+        "latency_ms": "0",  # time a MONICA takes per env
+        "workers": "1",  # number of envs worked on at once
+        "years": "30",  # years of results per env
+        "drain_timeout": "60",  # seconds to wait for the consumer after the producer finished
+        "report": "benchmark-report.json",
+    }
+
+    shared.update_config(config, sys.argv, print_config=True, allow_new_keys=False)
+
+    context = zmq.Context()
+    in_socket = context.socket(zmq.PULL)
+    in_socket.bind("tcp://*:" + config["in-port"])
+    out_socket = context.socket(zmq.PUSH)
+    out_socket.bind("tcp://*:" + config["out-port"])
+    stand_in = shared.MonicaStandIn(in_socket, out_socket, float(config["latency_ms"]), int(config["workers"]),
+                                    years=int(config["years"]))
+    stop = threading.Event()
+    stand_in_thread = threading.Thread(target=stand_in.run, args=(stop,), daemon=True)
+    stand_in_thread.start()
+
+    def extra_args(args):
+        return [arg for arg in args.split(";") if arg]
+
+    consumer = sp.Popen([
+        sys.executable,
+        f"run-consumer-{config['run']}.py",
+        "server=localhost",
+        f"port={config['out-port']}",
+        f"feedback-port={config['feedback-port']}",
+    ] + extra_args(config["consumer_args"]), stdout=open("benchmark-consumer.out", "w"), stderr=sp.STDOUT)
+
+    feedback_socket = context.socket(zmq.SUB)
+    feedback_socket.connect("tcp://localhost:" + config["feedback-port"])
+    feedback_socket.setsockopt_string(zmq.SUBSCRIBE, "")
+    time.sleep(1)  # let the consumer connect before the first env
+
+    start_time = time.perf_counter()
+    producer = sp.Popen([
+        sys.executable,
+        f"run-producer-{config['run']}.py",
+        "server=localhost",
+        f"server-port={config['in-port']}",
+        f"run-setups={config['run-setups']}",
+    ] + ([f"region={config['region']}"] if config["region"] else [])
+      + ([f"feedback-port={config['feedback-port']}"] if config["flow_control"] else [])
+      + extra_args(config["producer_args"]), stdout=open("benchmark-producer.out", "w"), stderr=sp.STDOUT)
+
+    backlogs = []
+    report = {"received": 0, "committed": 0, "backlog": 0}
+    producer_secs = None
+    drain_start_time = None
+    while True:
+        if feedback_socket.poll(1000):
+            report = feedback_socket.recv_json()
+            backlogs.append(report["backlog"])
+        if producer_secs is None and producer.poll() is not None:
+            producer_secs = time.perf_counter() - start_time
+            drain_start_time = time.perf_counter()
+        if drain_start_time is not None:
+            # all results went out to the consumer and it has no cells waiting for their row anymore
+            if not stand_in.due and report["received"] >= stand_in.sent and report["backlog"] == 0:
+                break
+            if time.perf_counter() - drain_start_time > float(config["drain_timeout"]):
+                print("consumer did not drain within ", config["drain_timeout"], " seconds")
+                break
+        if consumer.poll() is not None:
+            print("consumer exited with ", consumer.returncode)
+            break
+
+    stop.set()
+    stand_in_thread.join()
+    consumer.terminate()
+    consumer.wait()
+
+    benchmark_report = {
+        "run": config["run"],
+        "region": config["region"],
+        "run-setups": config["run-setups"],
+        "latency_ms": float(config["latency_ms"]),
+        "workers": int(config["workers"]),
+        "producer_exit_code": producer.returncode,
+        "producer_secs": round(producer_secs, 3) if producer_secs is not None else None,
+        "total_secs": round(time.perf_counter() - start_time, 3),
+        **stand_in.report(),
+        "consumer_received": report["received"],
+        "consumer_committed": report["committed"],
+        "backlog_max": max(backlogs, default=0),
+        "backlog_avg": round(sum(backlogs) / len(backlogs), 1) if backlogs else 0,
+    }
+    print("benchmark: ", json.dumps(benchmark_report))
+    if config["report"]:
+        with open(config["report"], "w") as _:
+            json.dump(benchmark_report, _, indent=2)
+
+
+if __name__ == "__main__":
+    run_benchmark()
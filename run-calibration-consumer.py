@@ -24,6 +24,8 @@ from pathlib import Path
 import sys
 import zmq
 
+import shared
+
 PATH_TO_REPO = Path(os.path.realpath(__file__)).parent
 PATH_TO_MAS_INFRASTRUCTURE_REPO = PATH_TO_REPO / "../mas-infrastructure"
 PATH_TO_PYTHON_CODE = PATH_TO_MAS_INFRASTRUCTURE_REPO / "src/python"
@@ -54,7 +56,10 @@ def run_consumer(server=None, port=None):
         "server": server if server else "login01.cluster.zalf.de",
         "writer_sr": None,
         "path_to_out": "out/",
-        "timeout": 600000  # 10min
+        "timeout": 600000,  # 10min
+        "latency_metrics": "",  # if set, write the latency histograms and setup throughput to this .json or .csv file
+        "metrics-port": "",  # if set, serve the latency metrics as prometheus text on this port
+        "metrics_interval": "30",  # seconds between the updates of the metrics
     }
 
     common.update_config(config, sys.argv, print_config=True, allow_new_keys=False)
@@ -82,15 +87,27 @@ def run_consumer(server=None, port=None):
     envs_received = 0
     no_of_envs_expected = None
 
+    # latency of the envs sent by the producer, a round is committed when its average yields are written
+    latency = None
+    if config["latency_metrics"] or config["metrics-port"]:
+        latency = shared.LatencyTracker(config["latency_metrics"], float(config["metrics_interval"]))
+        if config["metrics-port"]:
+            latency.serve(config["metrics-port"])
+
     while True:
         try:
             msg: dict = socket.recv_json()  # encoding="latin-1"
 
             custom_id = msg["customId"]
+            if "setup_meta" in custom_id:
+                # the setup registry, the yields are collected by country_id, which every env carries itself
+                continue
             if "no_of_sent_envs" in custom_id:
                 no_of_envs_expected = custom_id["no_of_sent_envs"]
             else:
                 envs_received += 1
+                if latency:
+                    latency.received(custom_id)
 
                 #with open(path_to_out_file, "a") as _:
                 #    _.write(f"received result customId: {custom_id}\n")
@@ -117,11 +134,16 @@ def run_consumer(server=None, port=None):
 
                 out_ip = fbp_capnp.IP.new_message(content=json.dumps(country_id_and_year_to_avg_yield))
                 writer.write(value=out_ip).wait()
+                if latency:
+                    latency.committed_all()
+                    latency.tick(force=True)
 
                 # reset and wait for next round
                 country_id_to_year_to_yields.clear()
                 no_of_envs_expected = None
                 envs_received = 0
+            elif latency:
+                latency.tick()
 
         except zmq.error.Again as _e:
             with open(path_to_out_file, "a") as _:
@@ -134,6 +156,8 @@ def run_consumer(server=None, port=None):
             print("Exception:", e)
             break
 
+    if latency:
+        latency.tick(force=True)
     print("exiting run_consumer()")
 
 
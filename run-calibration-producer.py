@@ -18,7 +18,6 @@
 import capnp
 from datetime import date, timedelta, datetime
 import json
-from netCDF4 import Dataset
 import numpy as np
 import os
 from pathlib import Path
@@ -99,6 +98,11 @@ def run_producer(server=None, port=None):
         "test_mode": "false",
         "path_to_out": "out/",
         "only_country_ids": "[]",  # "[10]",
+        "output_spec": "calibration",  # trim the env events to the outputs the calibration consumer uses
+        "eligibility_cache": True,  # cache why cells are skipped in the data dir, later rounds skip them at once
+        "log_sample_rate": "0",  # share of the envs logged (1 = all)
+        "summary_interval": "30",  # seconds between the stats summary lines
+        "stats_report": "producer-stats.json",  # stage timers and counters of the run, in path_to_out
     }
 
     common.update_config(config, sys.argv, print_config=True, allow_new_keys=False)
@@ -145,55 +149,15 @@ def run_producer(server=None, port=None):
     # utm32_crs = CRS.from_epsg(25832)
     # transformers[wgs84] = Transformer.from_crs(wgs84_crs, gk5_crs, always_xy=True)
 
-    # open netcdfs
-    path_to_soil_netcdfs = paths["path-to-soil-dir"] + "/" + config["resolution"] + "/"
-    if config["resolution"] == "5min":
-        soil_data = {
-            "sand": {"var": "SAND", "file": "SAND5min.nc", "conv_factor": 0.01},  # % -> fraction
-            "clay": {"var": "CLAY", "file": "CLAY5min.nc", "conv_factor": 0.01},  # % -> fraction
-            "corg": {"var": "OC", "file": "OC5min.nc", "conv_factor": 0.01},  # scale factor
-            "bd": {"var": "BD", "file": "BD5min.nc", "conv_factor": 0.01 * 1000.0},  # scale factor * 1 g/cm3 = 1000 kg/m3
-        }
-    else:
-        soil_data = None  # ["Sand5min.nc", "Clay5min.nc", "OC5min.nc", "BD5min.nc"]
-    soil_datasets = {}
-    soil_vars = {}
-    for elem, data in soil_data.items():
-        ds = Dataset(path_to_soil_netcdfs + data["file"], "r", format="NETCDF4")
-        soil_datasets[elem] = ds
-        soil_vars[elem] = ds.variables[data["var"]]
-
-    def create_soil_profile(row, col):
-        # skip first 4.5cm layer and just use 7 layers
-        layers = []
-
-        layer_depth = 8
-        # find the fill value for the soil data
-        for elem2 in soil_data.keys():
-            for i in range(8):
-                if np.ma.is_masked(soil_vars[elem2][i, row, col]):
-                    if i < layer_depth:
-                        layer_depth = i
-                    break
-        layer_depth -= 1
-
-        if layer_depth < 4:
-            return None
-        
-        for i, real_depth_cm, monica_depth_m in [(0, 4.5, 0), (1, 9.1, 0.1), (2, 16.6, 0.1), (3, 28.9, 0.1),
-                                                 (4, 49.3, 0.2), (5, 82.9, 0.3), (6, 138.3, 0.6), (7, 229.6, 0.7)][1:]:
-            if i <= layer_depth:
-                layers.append({
-                    "Thickness": [monica_depth_m, "m"],
-                    "SoilOrganicCarbon": [soil_vars["corg"][i, row, col] * soil_data["corg"]["conv_factor"], "%"],
-                    "SoilBulkDensity": [soil_vars["bd"][i, row, col] * soil_data["bd"]["conv_factor"], "kg m-3"],
-                    "Sand": [soil_vars["sand"][i, row, col] * soil_data["sand"]["conv_factor"], "fraction"],
-                    "Clay": [soil_vars["clay"][i, row, col] * soil_data["clay"]["conv_factor"], "fraction"]
-                })
-        return layers
+    global_soil_dataset = shared.GlobalSoilDataSet(paths["path-to-soil-dir"], config["resolution"])
+    # use the prebuilt catalog (create-soil-catalog.py) of the unique soil profiles if there is one
+    path_to_soil_catalog = shared.soil_catalog_path(paths["path-to-data-dir"], config["region"], config["resolution"])
+    if os.path.exists(path_to_soil_catalog + "/meta.json"):
+        global_soil_dataset.load_catalog(path_to_soil_catalog)
 
     sent_env_count = 0
     start_time = time.perf_counter()
+    stats = shared.ProducerStats(float(config["log_sample_rate"]), float(config["summary_interval"]))
 
     if len(run_setups) > 1 and run_setups[0] not in setups:
         return
@@ -299,6 +263,10 @@ def run_producer(server=None, port=None):
                     "sim": sim_json,
                     "climate": ""
                 })
+                if config["output_spec"]:
+                    # MONICA computes and sends only what the consumer uses
+                    env_template["events"] = shared.trim_events(env_template["events"],
+                                                                shared.OUTPUT_SPECS[config["output_spec"]])
 
                 c_lon_0 = -179.75
                 c_lat_0 = +89.25
@@ -314,17 +282,56 @@ def run_producer(server=None, port=None):
                                     -int(s_resolution * s_res_scale_factor))
                 no_of_lats = len(lats_scaled)
                 s_row_0 = int((s_lat_0 - (lats_scaled[0] / s_res_scale_factor)) / s_resolution)
-                for lat_scaled in lats_scaled:
+                lons_scaled = range(int(lat_lon_bounds["tl"]["lon"] * s_res_scale_factor),
+                                    int(lat_lon_bounds["br"]["lon"] * s_res_scale_factor) + 1,
+                                    int(s_resolution * s_res_scale_factor))
+                no_of_lons = len(lons_scaled)
+                s_col_0 = int(((lons_scaled[0] / s_res_scale_factor) - s_lon_0) / s_resolution)
+
+                # the metadata constant for the setup is registered once (forwarded by MONICA like the nodata envs),
+                # the envs only carry the setup_id and their cell
+                env_template["customId"] = {
+                    "setup_id": setup_id,
+                    "setup_meta": {
+                        "s_lat_0": s_lat_0, "s_lon_0": s_lon_0,
+                        "b_lat_0": b_lat_0, "b_lon_0": b_lon_0,
+                        "s_resolution": s_resolution,
+                        "s_row_0": s_row_0, "s_col_0": s_col_0,
+                        "no_of_s_cols": no_of_lons, "no_of_s_rows": no_of_lats,
+                        "region": region,
+                        "crop": crop
+                    },
+                    "nodata": True
+                }
+                env_template["pathToClimateCSV"] = ""
+                socket.send_json(env_template)
+
+                # the cells skipped are the same in every round with the same grids, soil and country filter
+                eligibility = None
+                if config["eligibility_cache"]:
+                    eligibility = shared.EligibilityCache(
+                        paths["path-to-data-dir"] + "/eligibility-cache",
+                        shared.eligibility_key(lat_lon_bounds, config["resolution"], setup["region"], management,
+                                               eco_data, crop_mask_data, planting_data, harvest_data, height_data,
+                                               slope_data, country_id_data, only_country_ids, global_soil_dataset),
+                        (no_of_lats, no_of_lons))
+
+                def skip_cell(r, c, reason):
+                    stats.lap("grid")
+                    stats.skip(reason)
+                    if eligibility:
+                        eligibility.set(r, c, reason)
+
+                for r, lat_scaled in enumerate(lats_scaled):
                     lat = lat_scaled / s_res_scale_factor
                     #print("lat:"+str(round(lat,2)))
                     print(str(round(lat, 2)), end=" ", flush=True)
 
-                    lons_scaled = range(int(lat_lon_bounds["tl"]["lon"] * s_res_scale_factor),
-                                        int(lat_lon_bounds["br"]["lon"] * s_res_scale_factor) + 1,
-                                        int(s_resolution * s_res_scale_factor))
-                    no_of_lons = len(lons_scaled)
-                    s_col_0 = int(((lons_scaled[0] / s_res_scale_factor) - s_lon_0) / s_resolution)
-                    for lon_scaled in lons_scaled:
+                    for c, lon_scaled in enumerate(lons_scaled):
+                        stats.start()
+                        if eligibility and eligibility.hit and eligibility.reasons[r, c]:
+                            stats.skip(eligibility.reason(r, c))
+                            continue
                         lon = lon_scaled / s_res_scale_factor
                         #print("lon:"+str(round(lon,2)), end=" ")
                         #print(".", end="", flush=True)
@@ -375,26 +382,35 @@ def run_producer(server=None, port=None):
                         else:
                             mgmt = None
                         if not mgmt or not valid_mgmt:
+                            skip_cell(r, c, "mgmt")
                             continue
 
                         crop_mask_value = crop_mask_data["value"](lat, lon, False)
                         if not crop_mask_value or crop_mask_value == 0:
+                            skip_cell(r, c, "crop_mask")
                             continue
 
                         country_id = country_id_data["value"](lat, lon, False)
                         if not country_id or (len(only_country_ids) > 0 and country_id not in only_country_ids):
+                            skip_cell(r, c, "country")
                             continue
 
                         height_nn = height_data["value"](lat, lon, False)
                         if not height_nn:
+                            skip_cell(r, c, "dem")
                             continue
 
                         slope = slope_data["value"](lat, lon, False)
                         if not slope:
                             slope = 0
+                        stats.lap("grid")
 
-                        soil_profile = create_soil_profile(s_row, s_col)
+                        soil_profile = global_soil_dataset.create_soil_profile(s_row, s_col)
+                        stats.lap("soil")
                         if not soil_profile or len(soil_profile) == 0:
+                            stats.skip("soil")
+                            if eligibility:
+                                eligibility.set(r, c, "soil")
                             continue
 
                         env_template["params"]["userCropParameters"]["__enable_T_response_leaf_expansion__"] = setup[
@@ -456,22 +472,29 @@ def run_producer(server=None, port=None):
 
                         env_template["customId"] = {
                             "setup_id": setup_id,
-                            "lat": lat, "lon": lon,
-                            "no_of_s_cols": no_of_lons, "no_of_s_rows": no_of_lats,
+                            "s_row": s_row, "s_col": s_col,
                             "env_id": sent_env_count+1,
                             "nodata": False,
                             "country_id": country_id,
                         }
-
-                        socket.send_json(env_template)
-                        #with open(path_to_out_file, "a") as _:
-                        #    _.write(f"sent env {sent_env_count} customId: {env_template['customId']}\n")
-                        #print("sent env ", sent_env_count, " customId: ", env_template["customId"])
+                        stats.lap("env")
+
+                        env_template["customId"]["sent"] = time.time()  # for the latency tracing of the consumer
+                        encoded_env = json.dumps(env_template).encode("utf8")  # as send_json does
+                        stats.lap("encode")
+                        socket.send(encoded_env, copy=False)
+                        stats.lap("send")
+                        stats.count("sent")
+                        if stats.sample():
+                            print("sent env ", sent_env_count, " customId: ", env_template["customId"])
+                        stats.tick()
 
                         sent_env_count += 1
 
                         if config["test_mode"] == "true" and sent_env_count == 100:
                             raise Exception("leave early for test")
+                if eligibility:
+                    eligibility.save()
             except Exception as e:
                 with open(path_to_out_file, "a") as _:
                     _.write(f"raised exception: {e}\n")
@@ -495,6 +518,7 @@ def run_producer(server=None, port=None):
             sent_env_count = 0
 
     stop_time = time.perf_counter()
+    stats.write_report(config["path_to_out"] + "/" + config["stats_report"] if config["stats_report"] else "")
 
     # write summary of used json files
     try:
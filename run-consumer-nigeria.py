@@ -51,25 +51,11 @@ PATHS = {
 
 
 def create_output(msg):
-    cm_count_to_vals = defaultdict(dict)
-    for data in msg.get("data", []):
-        results = data.get("results", [])
+    """the result of a cell in columns (see shared.CellResult), per cm_count"""
+    return shared.CellResult.decode(msg, shared.OUTPUT_SPECS["nigeria"]["grids"].keys(), split_single_lists=False)
 
-        for vals in results:
-            if "CM-count" in vals:
-                cm_count_to_vals[vals["CM-count"]].update(vals)
 
-    if len(cm_count_to_vals) > 0:
-        cmcs = list(cm_count_to_vals.keys())
-        cmcs.sort()
-        last_cmc = cmcs[-1]
-        if "Year" not in cm_count_to_vals[last_cmc]:
-            cm_count_to_vals.pop(last_cmc)
-
-    return cm_count_to_vals
-
-
-def write_row_to_grids(row_col_data, row, col_0, no_of_cols, header, path_to_output_dir, setup_id):
+def write_row_to_grids(row_col_data, row, col_0, no_of_cols, header, path_to_output_dir, setup_id, cube=None):
     """write grids row by row"""
 
     if not hasattr(write_row_to_grids, "nodata_row_count"):
@@ -81,26 +67,10 @@ def write_row_to_grids(row_col_data, row, col_0, no_of_cols, header, path_to_out
     def make_dict_nparr_int():
         return defaultdict(lambda: np.full((no_of_cols,), -9999, dtype=int))
 
-    output_grids = {
-        "Yield": {"data": make_dict_nparr(), "cast-to": "float", "digits": 2},
-        # "AbBiom": {"data": make_dict_nparr(), "cast-to": "float", "digits": 2},
-        # "LAI": {"data": make_dict_nparr(), "cast-to": "float", "digits": 2},
-        # "EmergDOY": {"data": make_dict_nparr_int(), "cast-to": "int"},
-        "HarvDOY": {"data": make_dict_nparr_int(), "cast-to": "int"},
-        # "tradefavg": {"data" : make_dict_nparr(), "cast-to": "float", "digits": 2},
-        # "heatredavg": {"data" : make_dict_nparr(), "cast-to": "float", "digits": 2},
-        # "frostredavg": {"data" : make_dict_nparr(), "cast-to": "float", "digits": 2},
-        "min_tmin": {"data": make_dict_nparr(), "cast-to": "float", "digits": 2},
-        "avg_tmin": {"data": make_dict_nparr(), "cast-to": "float", "digits": 2},
-        "avg_tavg": {"data": make_dict_nparr(), "cast-to": "float", "digits": 2},
-        "max_tmax": {"data": make_dict_nparr(), "cast-to": "float", "digits": 2},
-        "avg_tmax": {"data": make_dict_nparr(), "cast-to": "float", "digits": 2},
-        "sum_precip": {"data": make_dict_nparr(), "cast-to": "float", "digits": 2},
-        "avg_relhumid": {"data": make_dict_nparr(), "cast-to": "float", "digits": 2},
-        #"avg_globrad": {"data": make_dict_nparr(), "cast-to": "float", "digits": 2},
-    }
+    output_grids = {name: {"data": make_dict_nparr_int() if cast_to == "int" else make_dict_nparr(),
+                           "cast-to": cast_to, "digits": digits}
+                    for name, (cast_to, digits) in shared.OUTPUT_SPECS["nigeria"]["grids"].items()}
 
-    output_keys = list(output_grids.keys())
 
     cmc_to_crop = {}
 
@@ -108,67 +78,44 @@ def write_row_to_grids(row_col_data, row, col_0, no_of_cols, header, path_to_out
     # skip this part if we write just a nodata line
     if row in row_col_data:
         no_data_cols = no_of_cols
-        for col in range(col_0, col_0 + no_of_cols + 1):
-            if col in row_col_data[row]:
-                rcd_val = row_col_data[row][col]
-                if rcd_val == -9999:
-                    continue
-                else:
-                    no_data_cols -= 1
-                    cmc_and_year_to_vals = defaultdict(lambda: defaultdict(list))
-                    for cell_data in rcd_val:
-                        # if we got multiple datasets per cell, iterate over them and aggregate them in the following step
-                        for cm_count, data in cell_data.items():
-                            # store mapping cm_count to crop name for later file name creation
-                            if cm_count not in cmc_to_crop and "Crop" in data:
-                                cmc_to_crop[cm_count] = data["Crop"]
-
-                            for key in output_keys:
-                                # only further process/store data we actually received
-                                if key in data:
-                                    v = data[key]
-                                    if isinstance(v, list):
-                                        requiresSum = len(v) > 1 
-                                        for i, v_ in enumerate(v):
-                                            if requiresSum:
-                                                cmc_and_year_to_vals[(cm_count, data["Year"])][f"{key}_{i + 1}"].append(v_)
-                                            else:
-                                                cmc_and_year_to_vals[(cm_count, data["Year"])][key].append(v_)
-                                    else:
-                                        cmc_and_year_to_vals[(cm_count, data["Year"])][key].append(v)
-                                # if a key is missing, because that monica event was never raised/reached, create the empty list
-                                # so a no-data value is being produced
-                                else:
-                                    cmc_and_year_to_vals[(cm_count, data["Year"])][key] = []
-
-                    # potentially aggregate multiple data per cell and finally store them for this row
-                    for (cm_count, year), key_to_vals in cmc_and_year_to_vals.items():
-                        for key, vals in key_to_vals.items():
-                            output_vals = output_grids[key]["data"]
-                            if len(vals) > 0:
-                                output_vals[(cm_count, year)][col - col_0] = sum(vals) / len(vals)
-                            else:
-                                output_vals[(cm_count, year)][col - col_0] = -9999
+        results = []
+        cols = []
+        for col in sorted(row_col_data[row]):
+            rcd_val = row_col_data[row][col]
+            if rcd_val == -9999:
+                continue
+            no_data_cols -= 1
+            # if we got multiple datasets per cell, aggregate them
+            results.append(shared.CellResult.mean(rcd_val))
+            cols.append(col - col_0)
+
+        # store the values of all cells of the row at once
+        for (cm_count, year), key_to_row in shared.aggregate_row(results, cols, no_of_cols, cmc_to_crop).items():
+            for key, row_arr in key_to_row.items():
+                output_grids[key]["data"][(cm_count, year)][:] = row_arr
 
         is_no_data_row = no_data_cols == no_of_cols
 
+    if cube is not None:
+        # the rows go into the netcdf cube of the setup, the nodata rows are just its fill value
+        for key, y2d_ in output_grids.items():
+            for (cm_count, year), row_arr in y2d_["data"].items():
+                cube.write_row(key, year, cm_count, cmc_to_crop.get(cm_count, "none"), row, row_arr)
+        if row in row_col_data:
+            del row_col_data[row]
+        return
+
     if is_no_data_row:
         write_row_to_grids.nodata_row_count[setup_id] += 1
 
-    def write_nodata_rows(file_):
-        for _ in range(write_row_to_grids.nodata_row_count[setup_id]):
-            rowstr = " ".join(["-9999" for __ in range(no_of_cols)])
-            file_.write(rowstr + "\n")
+    # the nodata rows pending, they are written in front of the row
+    nodata_rows = shared.nodata_grid_line(no_of_cols) * write_row_to_grids.nodata_row_count[setup_id]
 
     # iterate over all prepared data for a single row and write row
     for key, y2d_ in output_grids.items():
         y2d = y2d_["data"]
         cast_to = y2d_["cast-to"]
         digits = y2d_.get("digits", 0)
-        if cast_to == "int":
-            mold = lambda x: str(int(x))
-        else:
-            mold = lambda x: str(round(x, digits))
 
         for (cm_count, year), row_arr in y2d.items():
             crop = cmc_to_crop[cm_count] if cm_count in cmc_to_crop else "none"
@@ -181,9 +128,7 @@ def write_row_to_grids(row_col_data, row, col_0, no_of_cols, header, path_to_out
                     write_row_to_grids.list_of_output_files[setup_id].append(path_to_file)
 
             with open(path_to_file, "a") as file_:
-                write_nodata_rows(file_)
-                rowstr = " ".join(["-9999" if int(x) == -9999 else mold(x) for x in row_arr])
-                file_.write(rowstr + "\n")
+                file_.write(nodata_rows + shared.format_grid_row(row_arr, cast_to, digits) + "\n")
 
     # clear the no-data row count when no-data rows have been written before a data row
     if not is_no_data_row:
@@ -197,13 +142,39 @@ def write_row_to_grids(row_col_data, row, col_0, no_of_cols, header, path_to_out
             and write_row_to_grids.nodata_row_count[setup_id] > 0:
         for path_to_file in write_row_to_grids.list_of_output_files[setup_id]:
             with open(path_to_file, "a") as file_:
-                write_nodata_rows(file_)
+                file_.write(nodata_rows)
         write_row_to_grids.nodata_row_count[setup_id] = 0
 
     if row in row_col_data:
         del row_col_data[row]
 
 
+def add_copied_result(data, row, col, output):
+    """add the result of an identical env sent for another cell"""
+    if row < data["next_row"] or col in data["row_col_data"].get(row, {}):
+        return
+    data["row_col_data"][row][col].append(output)
+    data["cols@row_received"][row] = data["cols@row_received"].get(row, 0) + 1
+
+
+def restore_from_journal(entries, setup_id_to_data):
+    """continue writing the grids after the last row of each setup committed to the journal"""
+
+    if not hasattr(write_row_to_grids, "nodata_row_count"):
+        write_row_to_grids.nodata_row_count = defaultdict(lambda: 0)
+        write_row_to_grids.list_of_output_files = defaultdict(list)
+
+    setup_id_to_entry = {entry["setup_id"]: entry for entry in entries}
+    for setup_id, entry in setup_id_to_entry.items():
+        data = setup_id_to_data[setup_id]
+        data["next_row"] = entry["row"] + 1
+        data["out_dir_exists"] = True
+        write_row_to_grids.nodata_row_count[setup_id] = entry["nodata_rows"]
+        write_row_to_grids.list_of_output_files[setup_id] = list(entry["sizes"].keys())
+        shared.restore_output_files(entry["out"], entry["sizes"])
+        print("resuming setup", setup_id, "at row", data["next_row"])
+
+
 def run_consumer(leave_after_finished_run=True, server={"server": None, "port": None}):
     """collect data from workers"""
 
@@ -211,7 +182,20 @@ def run_consumer(leave_after_finished_run=True, server={"server": None, "port":
         "mode": "mbm-local-remote",
         "port": server["port"] if server["port"] else "7777",  # local 7778,  remote 7777
         "server": server["server"] if server["server"] else "login01.cluster.zalf.de",
-        "timeout": 600000  # 10 minutes
+        "timeout": 600000,  # 10 minutes
+        "nodata-port": "",  # if set, receive the nodata cells directly from the producer on this port
+        "endpoints": "",  # host:port,... of several proxies to collect the results from instead of server:port
+        "journal": "",  # defaults to consumer-journal.jsonl in the output dir
+        "resume": False,  # continue the grids after the rows committed to the journal
+        "feedback-port": "",  # if set, report the results received to the producer (credit based flow control)
+        "feedback_interval": "1000",  # ms between the reports
+        "latency_metrics": "",  # if set, write the latency histograms and setup throughput to this .json or .csv file
+        "metrics-port": "",  # if set, serve the latency metrics as prometheus text on this port
+        "metrics_interval": "30",  # seconds between the updates of the metrics
+        "grid_backend": "ascii",  # or memmap: write the cells as they arrive, the .asc files when the setup is complete
+        # or netcdf: write the rows into one cube (grids.nc) per setup, see shared.NetCDFCube and shared.read_cube
+        "decode_workers": "0",  # if > 0, decode the results in this many processes, see shared.DecodePool
+        "decode_queue": "1000",  # max results received but not written yet with decode_workers
     }
 
     shared.update_config(config, sys.argv, print_config=True, allow_new_keys=False)
@@ -226,8 +210,31 @@ def run_consumer(leave_after_finished_run=True, server={"server": None, "port":
     context = zmq.Context()
     socket = context.socket(zmq.PULL)
 
-    socket.connect("tcp://" + config["server"] + ":" + config["port"])
+    # collect the results of several proxies (see endpoints of the producer)
+    for endpoint in (config["endpoints"].split(",") if config["endpoints"]
+                     else [config["server"] + ":" + config["port"]]):
+        socket.connect("tcp://" + endpoint)
     socket.RCVTIMEO = config["timeout"]
+    poller = zmq.Poller()
+    poller.register(socket, zmq.POLLIN)
+    # side channel for the nodata cells sent by the producer directly
+    nodata_socket = None
+    if config["nodata-port"]:
+        nodata_socket = context.socket(zmq.PULL)
+        nodata_socket.bind("tcp://*:" + config["nodata-port"])
+        poller.register(nodata_socket, zmq.POLLIN)
+    # the producer paces the envs by the results reported here
+    feedback = None
+    if config["feedback-port"]:
+        feedback_socket = context.socket(zmq.PUB)
+        feedback_socket.bind("tcp://*:" + config["feedback-port"])
+        feedback = shared.FeedbackReporter(feedback_socket, int(config["feedback_interval"]))
+    # time the envs spend in the proxy queue and on MONICA and the results waiting for their row
+    latency = None
+    if config["latency_metrics"] or config["metrics-port"]:
+        latency = shared.LatencyTracker(config["latency_metrics"], float(config["metrics_interval"]))
+        if config["metrics-port"]:
+            latency.serve(config["metrics-port"])
     leave = False
 
     setup_id_to_data = defaultdict(lambda: {
@@ -237,11 +244,100 @@ def run_consumer(leave_after_finished_run=True, server={"server": None, "port":
         "out_dir_exists": False,
         "row_col_data": defaultdict(lambda: defaultdict(list)),
         "cols@row_received": {},
-        "next_row": None
+        "nodata_ranges_received": set(),
+        "dedup_results": defaultdict(dict),  # row -> col -> result of an env sent for other cells too
+        "dedup_waiting": defaultdict(list),  # (row, col) of the sent env -> cells waiting for its result
+        "dedup_rows": 0,
+        "next_row": None,
+        "grids": None,  # shared.MemmapGrids if grid_backend is memmap
+        "cube": None,  # shared.NetCDFCube if grid_backend is netcdf
     })
 
+    # rows written to the grids, so a crashed run can be resumed
+    journal = shared.RunJournal(config["journal"] or config["out"] + "consumer-journal.jsonl",
+                                resume=config["resume"])
+    # the memory mapped grids resume from the cells they received, the journal is for the producer only
+    if config["resume"] and config["grid_backend"] != "memmap":
+        restore_from_journal(journal.entries, setup_id_to_data)
+
+    def write_cells_to_memmap(msg, data):
+        """write the cells into the memory mapped grids in the order they arrive and the .asc files
+        once every cell of the setup has been received"""
+        custom_id = msg["customId"]
+        setup_id = custom_id["setup_id"]
+        row_0 = custom_id["s_row_0"]
+        col_0 = custom_id["s_col_0"]
+        if data["grids"] is None:
+            data["out"] = f"{config['out']}{setup_id}_reg-{custom_id['region']}_{custom_id['crop']}" \
+                          f"_plant-{custom_id['planting']}_{custom_id['nitrogen']}-N/"
+            data["grids"] = shared.MemmapGrids(data["out"] + "memmap/", custom_id["no_of_s_rows"],
+                                               custom_id["no_of_s_cols"], resume=config["resume"])
+        grids = data["grids"]
+        if grids.received is None:
+            print("skipping cells of the already written setup", setup_id)
+            return
+
+        def committed(no_of_cells, row):
+            # like the ascii backend a row counts as committed once its last cell has arrived
+            if no_of_cells == 0 or not grids.row_complete(row - row_0):
+                return
+            if feedback:
+                feedback.committed += grids.shape[1]
+            if latency:
+                latency.committed(setup_id, row)
+            journal.append({"setup_id": setup_id, "row": row, "out": data["out"]})
+
+        if "nodata_ranges" in msg:
+            # nodata cells sent directly by the producer, they just have to be marked
+            for row, col, no_of_nodata_cols in msg["nodata_ranges"]:
+                committed(grids.receive(row - row_0, col - col_0, no_of_nodata_cols), row)
+        elif "fanout" in msg:
+            # cells getting the values of the cell an identical env was sent for
+            for row, col, env_row, env_col in msg["fanout"]:
+                if grids.is_received(env_row - row_0, env_col - col_0):
+                    committed(grids.copy_cell(row - row_0, col - col_0, env_row - row_0, env_col - col_0), row)
+                else:
+                    data["dedup_waiting"][(env_row, env_col)].append((row, col))
+        else:
+            row = custom_id["s_row"]
+            col = custom_id["s_col"]
+            # skip cells sent again by a resumed producer
+            if grids.is_received(row - row_0, col - col_0):
+                print("skipping already received cell", row, col, "of setup", setup_id)
+                return
+            if latency:
+                latency.received(custom_id)
+            if custom_id["nodata"]:
+                committed(grids.receive(row - row_0, col - col_0), row)
+            else:
+                output = msg["decoded"] if "decoded" in msg else create_output(msg)
+                committed(grids.write_cell(row - row_0, col - col_0, output.to_dict(), output.cmc_to_crop()), row)
+            for row_, col_ in data["dedup_waiting"].pop((row, col), []):
+                committed(grids.copy_cell(row_ - row_0, col_ - col_0, row - row_0, col - col_0), row_)
+
+        if grids.complete():
+            for path_to_file in grids.write_ascii(data["out"], data["header"],
+                                                  shared.OUTPUT_SPECS["nigeria"]["grids"]):
+                print("wrote", path_to_file)
+            grids.remove()
+            process_message.setup_count += 1
+
+    def write_incomplete_memmap_grids():
+        """write the .asc files of the setups still waiting for cells, the missing cells are nodata"""
+        for setup_id, data in setup_id_to_data.items():
+            if data["grids"] is not None and data["grids"].received is not None:
+                data["grids"].flush()
+                data["grids"].write_ascii(data["out"], data["header"], shared.OUTPUT_SPECS["nigeria"]["grids"])
+                print("wrote the incomplete grids of setup", setup_id, "with", data["grids"].no_of_received, "of",
+                      data["grids"].received.size, "cells received")
+
+    def close_cubes():
+        for data in setup_id_to_data.values():
+            if data["cube"] and data["cube"].ds.isopen():
+                data["cube"].close()
+
     def process_message(msg):
-        if len(msg["errors"]) > 0:
+        if len(msg.get("errors", [])) > 0:
             print("There were errors in message:", msg, "\nSkipping message!")
             return
 
@@ -260,14 +356,10 @@ def run_consumer(leave_after_finished_run=True, server={"server": None, "port":
 
         data = setup_id_to_data[setup_id]
 
-        row = custom_id["s_row"]
-        col = custom_id["s_col"]
         no_of_cols = custom_id["no_of_s_cols"]
         no_of_rows = custom_id["no_of_s_rows"]
         row_0 = custom_id["s_row_0"]
         col_0 = custom_id["s_col_0"]
-        if row not in data["cols@row_received"]:
-            data["cols@row_received"][row] = 0
         if data["next_row"] is None:
             data["next_row"] = row_0
         if data["header"] is None:
@@ -280,20 +372,62 @@ yllcorner    {custom_id["b_lat_0"] - (no_of_rows * custom_id["s_resolution"])}
 cellsize     {custom_id["s_resolution"]}
 NODATA_value -9999
 """
-        is_nodata = custom_id["nodata"]
-
-        debug_msg = "received work result " + str(process_message.received_env_count) \
-                    + " customId: " + str(msg.get("customId", "")) \
-                    + " next row: " + str(data["next_row"]) \
-                    + " cols@row to go: " + str(no_of_cols - data["cols@row_received"][row]) + "@" \
-                    + str(row) + " cols_per_row: " + str(no_of_cols)
-        print(debug_msg)
-        # debug_file.write(debug_msg + "\n")
-        if is_nodata:
-            data["row_col_data"][row][col] = -9999
+        if config["grid_backend"] == "memmap":
+            write_cells_to_memmap(msg, data)
+            process_message.received_env_count += 1
+            return leave
+        if "nodata_ranges" in msg:
+            # nodata cells sent directly by the producer, they just have to be counted
+            for row, col, no_of_nodata_cols in msg["nodata_ranges"]:
+                # skip rows already written and ranges sent again by a resumed producer
+                if row < data["next_row"] or (row, col, no_of_nodata_cols) in data["nodata_ranges_received"]:
+                    continue
+                data["nodata_ranges_received"].add((row, col, no_of_nodata_cols))
+                data["row_col_data"][row]  # make sure the row exists, missing cols are written as nodata
+                data["cols@row_received"][row] = data["cols@row_received"].get(row, 0) + no_of_nodata_cols
+            print("received nodata ranges: " + str(msg["nodata_ranges"]) + " next row: " + str(data["next_row"]))
+        elif "fanout" in msg:
+            # cells getting the result of an identical env sent for another cell
+            data["dedup_rows"] = custom_id["dedup_rows"]
+            for row, col, env_row, env_col in msg["fanout"]:
+                output = data["dedup_results"].get(env_row, {}).get(env_col)
+                if output is None:
+                    data["dedup_waiting"][(env_row, env_col)].append((row, col))
+                else:
+                    add_copied_result(data, row, col, output)
+            print("received fanout: " + str(msg["fanout"]) + " next row: " + str(data["next_row"]))
         else:
-            data["row_col_data"][row][col].append(create_output(msg))
-        data["cols@row_received"][row] += 1
+            row = custom_id["s_row"]
+            col = custom_id["s_col"]
+            # skip rows already written and cells sent again by a resumed producer
+            if row < data["next_row"] or col in data["row_col_data"].get(row, {}):
+                print("skipping already received cell", row, col, "of setup", setup_id)
+                return leave
+            if row not in data["cols@row_received"]:
+                data["cols@row_received"][row] = 0
+            is_nodata = custom_id["nodata"]
+            if latency:
+                latency.received(custom_id)
+
+            debug_msg = "received work result " + str(process_message.received_env_count) \
+                        + " customId: " + str(msg.get("customId", "")) \
+                        + " next row: " + str(data["next_row"]) \
+                        + " cols@row to go: " + str(no_of_cols - data["cols@row_received"][row]) + "@" \
+                        + str(row) + " cols_per_row: " + str(no_of_cols)
+            print(debug_msg)
+            # debug_file.write(debug_msg + "\n")
+            if is_nodata:
+                data["row_col_data"][row][col] = -9999
+            else:
+                output = msg["decoded"] if "decoded" in msg else create_output(msg)
+                data["row_col_data"][row][col].append(output)
+                if "dedup_rows" in custom_id:
+                    # keep the result for the cells with an identical env
+                    data["dedup_rows"] = custom_id["dedup_rows"]
+                    data["dedup_results"][row][col] = output
+                    for row_, col_ in data["dedup_waiting"].pop((row, col), []):
+                        add_copied_result(data, row_, col_, output)
+            data["cols@row_received"][row] += 1
 
         #process_message.received_env_count = process_message.received_env_count + 1
 
@@ -306,6 +440,9 @@ NODATA_value -9999
             print(path_to_out_dir)
             if not data["out_dir_exists"]:
                 if os.path.isdir(path_to_out_dir) and os.path.exists(path_to_out_dir):
+                    if config["resume"]:
+                        # nothing of this setup was committed, remove what was written before the crash
+                        shared.restore_output_files(path_to_out_dir, {})
                     data["out_dir_exists"] = True
                 else:
                     try:
@@ -315,8 +452,23 @@ NODATA_value -9999
                         print("c: Couldn't create dir:", path_to_out_dir, "! Exiting.")
                         exit(1)
 
+            if config["grid_backend"] == "netcdf" and data["cube"] is None:
+                data["cube"] = shared.NetCDFCube(path_to_out_dir + "grids.nc",
+                                                 shared.OUTPUT_SPECS["nigeria"]["grids"],
+                                                 custom_id, resume=config["resume"])
             write_row_to_grids(data["row_col_data"], data["next_row"], col_0, no_of_cols, data["header"],
-                               path_to_out_dir, setup_id)
+                               path_to_out_dir, setup_id, cube=data["cube"])
+            if data["cube"]:
+                data["cube"].sync()
+            if feedback:
+                feedback.committed += no_of_cols
+            if latency:
+                latency.committed(setup_id, data["next_row"])
+            journal.append({
+                "setup_id": setup_id, "row": data["next_row"], "out": path_to_out_dir,
+                "nodata_rows": write_row_to_grids.nodata_row_count[setup_id],
+                "sizes": {p: os.path.getsize(p) for p in write_row_to_grids.list_of_output_files[setup_id]}
+            })
 
             debug_msg = "wrote row: " + str(data["next_row"]) \
                         + " next_row: " + str(data["next_row"] + 1) \
@@ -326,6 +478,13 @@ NODATA_value -9999
 
             data["next_row"] += 1  # move to next row (to be written)
 
+            if data["cube"] and data["next_row"] == row_0 + no_of_rows:
+                data["cube"].close()
+
+            # no cell from here on can share an env with the rows left behind by more than dedup_rows
+            for env_row in [r for r in data["dedup_results"] if r < data["next_row"] - data["dedup_rows"]]:
+                del data["dedup_results"][env_row]
+
             # this setup is finished
             if leave_after_finished_run and data["next_row"] > (row_0 + no_of_rows):
                 process_message.setup_count += 1
@@ -334,24 +493,69 @@ NODATA_value -9999
         return leave
 
     process_message.received_env_count = 1
+    # the setup metadata, the producer sends it once per setup instead of with every env
+    setup_registry = shared.SetupRegistry()
+
+    def backlog():
+        """the cells received, but waiting for their row to be complete"""
+        return sum(data["cols@row_received"].get(row, 0)
+                   for data in setup_id_to_data.values() for row in data["row_col_data"])
+
+    # receive and decode the results in other processes, this one just writes the grids
+    pool = None
+    if int(config["decode_workers"]) > 0:
+        pool = shared.DecodePool(poller, socket, create_output, int(config["decode_workers"]),
+                                 int(config["decode_queue"]))
 
     while not leave:
         try:
-            # start_time_recv = timeit.default_timer()
-            msg = socket.recv_json()  # encoding="latin-1"
-            # elapsed = timeit.default_timer() - start_time_recv
-            # print("time to receive message" + str(elapsed))
-            # start_time_proc = timeit.default_timer()
-            leave = process_message(msg)
-            # elapsed = timeit.default_timer() - start_time_proc
-            # print("time to process message" + str(elapsed))
+            # with flow control, wake up to report even if no messages come in
+            timeout_ms = feedback.interval_ms if feedback else int(config["timeout"])
+            if pool:
+                msg, from_monica = pool.get(timeout_ms)
+                received = [] if msg is None else [(msg, from_monica)]
+            else:
+                received = [(sock.recv_json(), sock is socket)  # encoding="latin-1"
+                            for sock in dict(poller.poll(timeout_ms))]
+            if feedback:
+                feedback.report(backlog)
+            if latency:
+                if pool:
+                    latency.gauge("decode_queue_depth", pool.depth())
+                latency.tick()
+            if not received:
+                if feedback and feedback.idle_ms() < int(config["timeout"]):
+                    continue
+                raise zmq.error.Again()
+            for msg, from_monica in received:
+                if feedback:
+                    feedback.message_received(from_monica=from_monica)
+                # start_time_proc = timeit.default_timer()
+                for msg in setup_registry.resolve(msg):
+                    leave = process_message(msg)
+                # elapsed = timeit.default_timer() - start_time_proc
+                # print("time to process message" + str(elapsed))
         except zmq.error.Again as _e:
+            if latency:
+                latency.tick(force=True)
+            if config["grid_backend"] == "memmap":
+                write_incomplete_memmap_grids()
+            close_cubes()
+            if pool:
+                pool.close()
             print('no response from the server (with "timeout"=%d ms) ' % socket.RCVTIMEO)
             return
         except Exception as e:
             print("Exception:", e)
             # continue
 
+    if latency:
+        latency.tick(force=True)
+    if config["grid_backend"] == "memmap":
+        write_incomplete_memmap_grids()
+    close_cubes()
+    if pool:
+        pool.close()
     print("exiting run_consumer()")
     # debug_file.close()
 
@@ -0,0 +1,102 @@
+#!/usr/bin/python
+# -*- coding: UTF-8
+
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/. */
+
+# Authors:
+# Michael Berg-Mohnicke <michael.berg@zalf.de>
+#
+# Maintainers:
+# Currently maintained by the authors.
+#
+# This file has been created at the Institute of
+# Landscape Systems Analysis at the ZALF.
+# Copyright (C: Leibniz Centre for Agricultural Landscape Research (ZALF)
+
+
+import importlib.util
+import os
+from pathlib import Path
+import sys
+import time
+import traceback
+import zmq
+
+import shared
+
+PATH_TO_REPO = Path(os.path.realpath(__file__)).parent
+
+
+def load_producer(name):
+    """import run-producer-<name>.py as a module"""
+    spec = importlib.util.spec_from_file_location(f"run_producer_{name}", PATH_TO_REPO / f"run-producer-{name}.py")
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def request_run(port, args):
+    """send a run request (list of key=value args) to the daemon on port and wait for the run to finish"""
+    context = zmq.Context.instance()
+    socket = context.socket(zmq.REQ)
+    socket.connect("tcp://localhost:" + port)
+    socket.send_json({"args": args})
+    reply = socket.recv_json()
+    socket.close()
+    return reply
+
+
+def run_producer_daemon():
+    """keep a producer resident and run it for every request coming in on port, the grids (load_grid_cached),
+    the soil dataset and the last work plan stay loaded between the runs, so only the first run pays for reading
+    them, the args of the daemon which are not its own are the defaults of every run, the args of a request
+    override them, e.g. {"args": ["setups-file=sim_setups_nigeria.csv", "run-setups=[3,4]"]}"""
+
+    config = {
+        "producer": "nigeria",  # africa|nigeria
+        "port": "6650",  # local port for the run requests
+        "request": "",  # if set, send this run request (key=value;...) to the daemon on port instead of serving
+    }
+
+    shared.update_config(config, sys.argv, print_config=True, allow_new_keys=False)
+
+    if config["request"]:
+        reply = request_run(config["port"], config["request"].split(";"))
+        print("run finished: ", reply)
+        return
+
+    default_args = [arg for arg in sys.argv[1:] if arg.split("=", maxsplit=1)[0] not in config]
+    path_to_producer = str(PATH_TO_REPO / f"run-producer-{config['producer']}.py")
+    producer = load_producer(config["producer"])
+
+    context = zmq.Context.instance()
+    socket = context.socket(zmq.REP)
+    socket.bind("tcp://127.0.0.1:" + config["port"])
+    print("producer daemon ready for run requests on port ", config["port"])
+
+    while True:
+        request = socket.recv_json()
+        if request.get("stop"):
+            socket.send_json({"ok": True})
+            break
+
+        # the producer reads its config from the command line
+        sys.argv = [path_to_producer] + default_args + request.get("args", [])
+        start_time = time.perf_counter()
+        try:
+            producer.run_producer()
+            reply = {"ok": True}
+        except (Exception, SystemExit) as e:
+            traceback.print_exc()
+            reply = {"ok": False, "error": repr(e)}
+        reply["secs"] = round(time.perf_counter() - start_time, 3)
+        print("run request: ", request, " reply: ", reply)
+        socket.send_json(reply)
+
+    print("exiting run_producer_daemon()")
+
+
+if __name__ == "__main__":
+    run_producer_daemon()
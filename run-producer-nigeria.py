@@ -15,9 +15,9 @@
 # Landscape Systems Analysis at the ZALF.
 # Copyright (C: Leibniz Centre for Agricultural Landscape Research (ZALF)
 
-from datetime import date, timedelta
+from collections import defaultdict
+from itertools import zip_longest
 import json
-import numpy as np
 import os
 from pathlib import Path
 import sys
@@ -84,9 +84,6 @@ PATHS = {
 
 
 def run_producer(server={"server": None, "port": None}):
-    context = zmq.Context()
-    socket = context.socket(zmq.PUSH)  # pylint: disable=no-member
-
     config = {
         "mode": "mbm-local-remote",
         "server-port": server["port"] if server["port"] else "6666",  # local: 6667, remote 6666
@@ -101,11 +98,63 @@ def run_producer(server={"server": None, "port": None}):
         "crop.json": "crop.json",
         "site.json": "site.json",
         "setups-file": "sim_setups_nigeria_army_worms.csv",
-        "run-setups": "[1]"
+        "run-setups": "[1]",
+        "load_soil_window": True,
+        "nodata-server": "localhost",
+        "nodata-port": "",  # if set, nodata cells are sent directly to the consumer listening on this port
+        "shards": "1",  # number of producer processes, each sending every shards-th row
+        "shard": "",  # set for the shard processes only
+        "journal": "producer-journal.jsonl",  # rows sent, a shard appends .shard-<i>
+        "consumer-journal": "",  # if resuming, re-send all rows not committed to this consumer journal
+        "resume": False,  # skip the rows already sent (or committed by the consumer)
+        "by_climate_cell": False,  # send the envs climate cell by climate cell instead of row by row
+        "endpoints": "",  # host:port,... of several proxies, all envs of a climate cell go to the same proxy
+        "inline_climate": False,  # read the climate csvs here and send the data within the envs
+        "climate_cache_size": "64",  # number of climate cells kept parsed for inline_climate
+        "dedup_envs": False,  # send identical envs only once, the consumer copies the result (needs nodata-port)
+        "fast_env_encoding": False,  # serialize the env template once per setup, per cell only the changed values
+        "output_spec": "",  # africa|nigeria, trim the env events to the outputs this consumer type uses
+        "feedback-server": "localhost",
+        "feedback-port": "",  # if set, pace the envs by the results the consumer reports on this port
+        "window": "10000",  # max number of envs in flight (per shard) with feedback-port set
+        "log_sample_rate": "0.01",  # share of the envs logged (1 = all)
+        "summary_interval": "30",  # seconds between the stats summary lines
+        "stats_report": "producer-stats.json",  # stage timers and counters of the run, a shard appends .shard-<i>
+        "sweep_setups": False,  # walk the grid once for all run-setups, sending the envs of each cell for every setup
+        "eligibility_cache": False,  # cache the cells without soil in the data dir, they are sent as nodata at once
+        "dry-run": False,  # go through the cells without sending, print the envs, bytes and climate files per setup
+        "dry_run_bandwidth": "100",  # MB/s to the proxies, for the wall time estimate of a dry run
     }
 
     shared.update_config(config, sys.argv, print_config=True, allow_new_keys=False)
 
+    no_of_shards = int(config["shards"])
+    if no_of_shards > 1 and config["shard"] == "":
+        start_time = time.perf_counter()
+        exit_codes = shared.run_shards(run_producer, no_of_shards, server)
+        print("running ", no_of_shards, " producer shards took ", (time.perf_counter() - start_time),
+              " seconds, exit codes: ", exit_codes)
+        return
+    shard = int(config["shard"]) if config["shard"] else 0
+
+    # rows sent, so a crashed run can be resumed
+    path_to_journal = config["journal"] + (f".shard-{shard}" if no_of_shards > 1 else "")
+    # a dry run doesn't write the journal, but estimates a resumed run from the journal of the real one
+    journal = shared.RunJournal(os.devnull, resume=False) if config["dry-run"] else \
+        shared.RunJournal(path_to_journal, resume=config["resume"])
+    done_rows = set()
+    if config["resume"]:
+        if config["consumer-journal"]:
+            done_rows = shared.committed_rows(config["consumer-journal"])
+        else:
+            entries = shared.read_journal(path_to_journal) if config["dry-run"] else journal.entries
+            done_rows = {(entry["setup_id"], entry["row"]) for entry in entries}
+        print("resuming, skipping ", len(done_rows), " rows")
+
+    # shared by the runs of a resident producer (run-producer-daemon.py), the envs still queued when a run returns
+    # are delivered nevertheless
+    context = zmq.Context.instance()
+
     s_resolution = {"5min": 5 / 60., "30sec": 30 / 3600.}[config["resolution"]]
     s_res_scale_factor = {"5min": 60., "30sec": 3600.}[config["resolution"]]
 
@@ -123,7 +172,31 @@ def run_producer(server={"server": None, "port": None}):
     # select paths
     paths = PATHS[config["mode"]]
     # connect to monica proxy (if local, it will try to connect to a locally started monica)
-    socket.connect("tcp://" + config["server"] + ":" + str(config["server-port"]))
+    # with several proxies, the workers behind a proxy get all envs of a climate cell and read its file from the cache
+    # a dry run counts the messages instead of sending them
+    dry_run = shared.DryRun(float(config["dry_run_bandwidth"])) if config["dry-run"] else None
+    sockets = []
+    for endpoint in (config["endpoints"].split(",") if config["endpoints"]
+                     else [config["server"] + ":" + str(config["server-port"])]):
+        sockets.append(dry_run.socket() if dry_run else context.socket(zmq.PUSH))  # pylint: disable=no-member
+        sockets[-1].connect("tcp://" + endpoint)
+    socket = sockets[0]
+    # side channel to the consumer for the nodata cells, so they don't make a round trip through MONICA
+    nodata_socket = None
+    if config["nodata-port"]:
+        nodata_socket = dry_run.socket() if dry_run else context.socket(zmq.PUSH)  # pylint: disable=no-member
+        nodata_socket.connect("tcp://" + config["nodata-server"] + ":" + str(config["nodata-port"]))
+    # credit based pacing, the consumer reports the results it received
+    credits = None
+    if config["feedback-port"] and not dry_run:
+        feedback_socket = context.socket(zmq.SUB)  # pylint: disable=no-member
+        feedback_socket.setsockopt_string(zmq.SUBSCRIBE, "")  # pylint: disable=no-member
+        feedback_socket.connect("tcp://" + config["feedback-server"] + ":" + str(config["feedback-port"]))
+        credits = shared.CreditWindow(feedback_socket, int(config["window"]), no_of_shards)
+    # the cells getting the result of an identical env are sent over the side channel too
+    dedup_envs = config["dedup_envs"] and nodata_socket is not None
+    if config["dedup_envs"] and not dedup_envs:
+        print("dedup_envs needs the nodata-port to be set, sending all envs")
 
     # read setup from csv file
     setups = monica_run_lib.read_sim_setups(config["setups-file"])
@@ -138,24 +211,31 @@ def run_producer(server={"server": None, "port": None}):
     # transformers[wgs84] = Transformer.from_crs(wgs84_crs, gk5_crs, always_xy=True)
 
     # eco regions
-    path_to_eco_grid = (paths["path-to-data-dir"] +
-                        "/agro_ecological_regions_nigeria/agro-eco-regions_0.038deg_4326_wgs84_nigeria.asc")
-    eco_metadata, _ = monica_run_lib.read_header(path_to_eco_grid)
-    eco_grid = np.loadtxt(path_to_eco_grid, dtype=int, skiprows=len(eco_metadata))
-    aer_ll0r = shared.get_lat_0_lon_0_resolution_from_grid_metadata(eco_metadata)
+    eco_data = shared.load_grid_cached(
+        paths["path-to-data-dir"] +
+        "/agro_ecological_regions_nigeria/agro-eco-regions_0.038deg_4326_wgs84_nigeria.asc", int)
 
-    global_soil_dataset = shared.GlobalSoilDataSet(paths["path-to-soil-dir"], config["resolution"])
+    global_soil_dataset = shared.global_soil_dataset_cached(paths["path-to-soil-dir"], config["resolution"])
+    climate_data_cache = shared.ClimateDataCache(int(config["climate_cache_size"]))
+    stats = shared.ProducerStats(float(config["log_sample_rate"]), float(config["summary_interval"]))
 
     all_sent_envs_count = 0
     start_time = time.perf_counter()
-    # run calculations for each setup
-    for _, setup_id in enumerate(run_setups):
+    # soil profiles of the rows being sent, they are the same for all setups
+    soil_profiles = {}
+
+    def run_setup(setup_id):
+        """send the envs of a setup, yields after each group of rows, so several setups can walk the grid together"""
+        nonlocal all_sent_envs_count
 
-        sent_envs_count = 0
+        # continue counting after the envs sent before resuming
+        sent_envs_count = sum(entry["envs"] for entry in journal.entries if entry["setup_id"] == setup_id)
 
         if setup_id not in setups:
-            continue
+            return
         start_setup_time = time.perf_counter()
+        if dry_run:
+            dry_run.switch_to(setup_id)
 
         setup = setups[setup_id]
         gcm = setup["gcm"]
@@ -169,6 +249,8 @@ def run_producer(server={"server": None, "port": None}):
             "br": {"lat": float(config["end_lat"]), "lon": float(config["end_lon"])}
         })
 
+        planting_data = harvest_data = None
+        valid_aers = None
         if setup["region"] == "nigeria":
             planting = setup["planting"].lower()
             nitrogen = setup["nitrogen"].lower()
@@ -176,36 +258,20 @@ def run_producer(server={"server": None, "port": None}):
             # load management data
             management = monica_run_lib.read_csv(paths["path-to-data-dir"] +
                                           "/agro_ecological_regions_nigeria/" + management_file, key="id")
+            valid_aers = [aer for aer, mgmt in management.items()
+                          if aer > 0 and shared.check_for_nill_dates(mgmt) and len(mgmt) > 1]
         else:
             planting = nitrogen = management = None
 
-            path_to_planting_grid = \
-                paths["path-to-data-dir"] + f"/{setup['crop']}-planting-doy_0.5deg_4326_wgs84_africa.asc"
-            planting_metadata, _ = monica_run_lib.read_header(path_to_planting_grid)
-            planting_grid = np.loadtxt(path_to_planting_grid, dtype=int, skiprows=len(planting_metadata))
-            # print("read: ", path_to_planting_grid)
-            planting_ll0r = shared.get_lat_0_lon_0_resolution_from_grid_metadata(planting_metadata)
-
-            path_to_harvest_grid = \
-                paths["path-to-data-dir"] + f"/{setup['crop']}-harvest-doy_0.5deg_4326_wgs84_africa.asc"
-            harvest_metadata, _ = monica_run_lib.read_header(path_to_harvest_grid)
-            harvest_grid = np.loadtxt(path_to_harvest_grid, dtype=int, skiprows=len(harvest_metadata))
-            # print("read: ", path_to_harvest_grid)
-            harvest_ll0r = shared.get_lat_0_lon_0_resolution_from_grid_metadata(harvest_metadata)
-
-        # height data for germany
-        path_to_dem_grid = setup["path_to_dem_asc_grid"]
-        dem_metadata, _ = monica_run_lib.read_header(path_to_dem_grid)
-        dem_grid = np.loadtxt(path_to_dem_grid, dtype=float, skiprows=len(dem_metadata))
-        # print("read: ", path_to_dem_grid)
-        dem_ll0r = shared.get_lat_0_lon_0_resolution_from_grid_metadata(dem_metadata)
+            planting_data = shared.load_grid_cached(
+                paths["path-to-data-dir"] + f"/{setup['crop']}-planting-doy_0.5deg_4326_wgs84_africa.asc", int)
+            harvest_data = shared.load_grid_cached(
+                paths["path-to-data-dir"] + f"/{setup['crop']}-harvest-doy_0.5deg_4326_wgs84_africa.asc", int)
 
+        # height data
+        dem_data = shared.load_grid_cached(setup["path_to_dem_asc_grid"], float)
         # slope data
-        path_to_slope_grid = setup["path_to_slope_asc_grid"]
-        slope_metadata, _ = monica_run_lib.read_header(path_to_slope_grid)
-        slope_grid = np.loadtxt(path_to_slope_grid, dtype=float, skiprows=len(slope_metadata))
-        print("read: ", path_to_slope_grid)
-        slope_ll0r = shared.get_lat_0_lon_0_resolution_from_grid_metadata(slope_metadata)
+        slope_data = shared.load_grid_cached(setup["path_to_slope_asc_grid"], float)
 
         # read template sim.json
         with open(setup.get("sim.json", config["sim.json"])) as _:
@@ -214,7 +280,6 @@ def run_producer(server={"server": None, "port": None}):
         if setup["start_date"]:
             sim_json["climate.csv-options"]["start-date"] = str(setup["start_date"])
         if setup["end_date"]:
-            end_year = int(setup["end_date"].split("-")[0])
             sim_json["climate.csv-options"]["end-date"] = str(setup["end_date"])
 
             # read template site.json
@@ -242,142 +307,199 @@ def run_producer(server={"server": None, "port": None}):
             "sim": sim_json,
             "climate": ""
         })
-
-        c_lon_0 = -179.75
-        c_lat_0 = +89.25
-        c_resolution = 0.5
+        if config["output_spec"]:
+            # MONICA computes and sends only what the consumer writes
+            env_template["events"] = shared.trim_events(env_template["events"],
+                                                        shared.OUTPUT_SPECS[config["output_spec"]])
 
         s_lat_0 = region_to_lat_lon_bounds["earth"][config["resolution"]]["tl"]["lat"]
         s_lon_0 = region_to_lat_lon_bounds["earth"][config["resolution"]]["tl"]["lon"]
         b_lat_0 = lat_lon_bounds["tl"]["lat"]
         b_lon_0 = lat_lon_bounds["tl"]["lon"]
 
-        lats_scaled = range(int(lat_lon_bounds["tl"]["lat"] * s_res_scale_factor),
-                            int(lat_lon_bounds["br"]["lat"] * s_res_scale_factor) - 1,
-                            -int(s_resolution * s_res_scale_factor))
-        no_of_lats = len(lats_scaled)
-        s_row_0 = int((s_lat_0 - (lats_scaled[0] / s_res_scale_factor)) / s_resolution)
-        for lat_scaled in lats_scaled:
-            lat = lat_scaled / s_res_scale_factor
-
-            print(lat, )
-
-            lons_scaled = range(int(lat_lon_bounds["tl"]["lon"] * s_res_scale_factor),
-                                int(lat_lon_bounds["br"]["lon"] * s_res_scale_factor) + 1,
-                                int(s_resolution * s_res_scale_factor))
-            no_of_lons = len(lons_scaled)
-            s_col_0 = int(((lons_scaled[0] / s_res_scale_factor) - s_lon_0) / s_resolution)
-            for lon_scaled in lons_scaled:
-                lon = lon_scaled / s_res_scale_factor
-                print(lon, )
+        # compile the sweep over the bounding box into a table of the cells passing the grid based checks
+        stats.start()
+        plan = shared.create_work_plan_cached(lat_lon_bounds, s_lat_0, s_lon_0, s_resolution, s_res_scale_factor,
+                                              eco_data=eco_data if setup["region"] == "nigeria" else None,
+                                              valid_aers=valid_aers,
+                                              planting_data=planting_data, harvest_data=harvest_data,
+                                              dem_data=dem_data, slope_data=slope_data)
+        no_of_lats = plan["no_of_rows"]
+        no_of_lons = plan["no_of_cols"]
+        s_row_0 = plan["s_row_0"]
+        s_col_0 = plan["s_col_0"]
+        cells = plan["cells"]
+        stats.lap("plan")
+        print("work plan: ", len(cells["row"]), " of ", no_of_lats * no_of_lons, " cells eligible")
+
+        path_to_soil_catalog = shared.soil_catalog_path(paths["path-to-data-dir"], region, config["resolution"])
+        if os.path.exists(path_to_soil_catalog + "/meta.json"):
+            # prebuilt catalog (create-soil-catalog.py) of the unique soil profiles of the region
+            if not global_soil_dataset.catalog or global_soil_dataset.catalog["path"] != path_to_soil_catalog:
+                global_soil_dataset.load_catalog(path_to_soil_catalog)
+        elif config["load_soil_window"]:
+            # read the soil data of the whole bounding box at once instead of cell by cell
+            global_soil_dataset.load_window(plan["s_rows"][0], plan["s_cols"][0],
+                                            plan["s_rows"][-1] - plan["s_rows"][0] + 1,
+                                            plan["s_cols"][-1] - plan["s_cols"][0] + 1)
+        stats.lap("soil")
+        if config["eligibility_cache"]:
+            # the cells without a valid soil profile are known from an earlier run with the same grids and soil
+            key = shared.eligibility_key(lat_lon_bounds, config["resolution"], setup["region"], valid_aers, eco_data,
+                                         planting_data, harvest_data, dem_data, slope_data, global_soil_dataset)
+            plan = shared.apply_eligibility_cache(plan, global_soil_dataset,
+                                                  paths["path-to-data-dir"] + "/eligibility-cache", key)
+            cells = plan["cells"]
+            stats.lap("eligibility")
+            print("eligible after the soil check: ", len(cells["row"]), " cells")
+
+        # cells sharing an env lie in the same climate cell (0.5°), so not more than dedup_rows rows apart
+        dedup_rows = int(0.5 / s_resolution) + 1
+        env_hash_to_cell = {}
+        # created with the first env of the setup, when all keys set per cell exist
+        env_encoder = None
+
+        # the metadata constant for the setup is registered once, the envs only carry the setup_id and their cell
+        setup_meta = {
+            "s_lat_0": s_lat_0, "s_lon_0": s_lon_0,
+            "b_lat_0": b_lat_0, "b_lon_0": b_lon_0,
+            "s_resolution": s_resolution,
+            "s_row_0": s_row_0, "s_col_0": s_col_0,
+            "no_of_s_cols": no_of_lons, "no_of_s_rows": no_of_lats,
+            "planting": planting,
+            "nitrogen": nitrogen,
+            "region": region,
+            "crop": crop
+        }
+        registry_custom_id = {"setup_id": setup_id, "setup_meta": setup_meta, "nodata": True}
+        if nodata_socket:
+            nodata_socket.send_json({"customId": registry_custom_id})
+        else:
+            # forwarded by MONICA like the nodata envs
+            env_template["customId"] = registry_custom_id
+            env_template["pathToClimateCSV"] = ""
+            if credits:
+                credits.acquire()
+            socket.send_json(env_template)
 
-                c_col = int((lon - c_lon_0) / c_resolution)
-                c_row = int((c_lat_0 - lat) / c_resolution)
+        # customId of the messages sent directly to the consumer
+        side_channel_custom_id = {"setup_id": setup_id, "nodata": True, "dedup_rows": dedup_rows}
 
-                s_col = int((lon - s_lon_0) / s_resolution)
-                s_row = int((s_lat_0 - lat) / s_resolution)
+        def send_nodata_msg(sec, r, c):
+            aer = int(plan["aer"][r, c]) if plan["aer"] is not None else None
+            env_template["customId"] = {
+                "setup_id": setup_id,
+                "s_row": plan["s_rows"][r], "s_col": plan["s_cols"][c],
+                "env_id": shared.env_id(sec, shard, no_of_shards),
+                "nodata": True,
+                "aer": str(aer) if aer else "none",
+                "shard": shard,
+            }
+            if credits:
+                credits.acquire()
+            env_template["customId"]["sent"] = time.time()  # for the latency tracing of the consumer
+            socket.send_json(env_template)
+            if stats.sample():
+                print("sent nodata env ", sec, " customId: ", env_template["customId"])
+
+        def send_nodata(r, runs):
+            """send the nodata cells (runs of col and count) of row r, either as run-length encoded ranges
+            directly to the consumer or as single envs through MONICA, returns the number of cells sent"""
+            if not runs:
+                return 0
+            if nodata_socket:
+                nodata_socket.send_json({
+                    "customId": side_channel_custom_id,
+                    "nodata_ranges": [[plan["s_rows"][r], plan["s_cols"][c], n] for c, n in runs]
+                })
+            else:
+                sec = sent_envs_count
+                for c, n in runs:
+                    for c_ in range(c, c + n):
+                        send_nodata_msg(sec, r, c_)
+                        sec += 1
+            no_of_cells = sum(n for _, n in runs)
+            stats.count("nodata", no_of_cells)
+            return no_of_cells
+
+        def send_fanout(fanout_cells):
+            """tell the consumer which cells (s_row, s_col, s_row and s_col of the sent env) get the result
+            of an identical env, returns the number of cells"""
+            if fanout_cells:
+                nodata_socket.send_json({"customId": side_channel_custom_id, "fanout": fanout_cells})
+            return len(fanout_cells)
+
+        for rows in shared.row_groups(plan, shard, no_of_shards, config["by_climate_cell"]):
+            if dry_run:
+                dry_run.switch_to(setup_id)
+            no_of_rows = len(rows)
+            rows = [r for r in rows if (setup_id, plan["s_rows"][r]) not in done_rows]
+            stats.skip("done_row", no_of_rows - len(rows))
+            # the profiles of the rows above are not needed anymore, neither by this nor by the other setups
+            if rows:
+                for old_s_row in [s_row for s_row in soil_profiles if s_row < plan["s_rows"][rows[0]]]:
+                    del soil_profiles[old_s_row]
+            row_to_count = {}
+            for r in rows:
+                print(plan["lats"][r], )
+                row_to_count[r] = send_nodata(r, shared.true_runs(~plan["eligible"][r]))
+                sent_envs_count += row_to_count[r]
+            soil_nodata_cols = defaultdict(list)
+            fanout_cells = defaultdict(list)
+
+            for r, i in shared.cell_order(plan, rows, config["by_climate_cell"]):
+                stats.start()
+                lat = plan["lats"][r]
+                c = cells["col"][i]
+                c_row = plan["c_rows"][r]
+                c_col = plan["c_cols"][c]
+                s_row = plan["s_rows"][r]
+                s_col = plan["s_cols"][c]
+                aer = cells["aer"][i] if setup["region"] == "nigeria" else None
 
                 # set management
-                mgmt = None
-                aer = None
                 if setup["region"] == "nigeria":
-                    aer_col = int((lon - aer_ll0r["lon_0"]) / aer_ll0r["res"])
-                    aer_row = int((aer_ll0r["lat_0"] - lat) / aer_ll0r["res"])
-                    if 0 <= aer_row < int(eco_metadata["nrows"]) \
-                            and 0 <= aer_col < int(eco_metadata["ncols"]):
-                        aer = eco_grid[aer_row, aer_col]
-                        if aer > 0 and aer in management:
-                            mgmt = management[aer]
-                else:
-                    mgmt = {}
-
-                    planting_col = int((lon - planting_ll0r["lon_0"]) / planting_ll0r["res"])
-                    planting_row = int((planting_ll0r["lat_0"] - lat) / planting_ll0r["res"])
-                    if 0 <= planting_row < int(planting_metadata["nrows"]) \
-                            and 0 <= planting_col < int(planting_metadata["ncols"]):
-                        planting_doy = int(planting_grid[planting_row, planting_col])
-                        if planting_doy != planting_metadata["nodata_value"]:
-                            d = date(2023, 1, 1) + timedelta(days=planting_doy-1)
-                            mgmt["Sowing date"] = f"0000-{d.month:02}-{d.day:02}"
-
-                    harvest_col = int((lon - harvest_ll0r["lon_0"]) / harvest_ll0r["res"])
-                    harvest_row = int((harvest_ll0r["lat_0"] - lat) / harvest_ll0r["res"])
-                    if 0 <= harvest_row < int(harvest_metadata["nrows"]) \
-                            and 0 <= harvest_col < int(harvest_metadata["ncols"]):
-                        harvest_doy = int(harvest_grid[harvest_row, harvest_col])
-                        if harvest_doy != harvest_metadata["nodata_value"]:
-                            d = date(2023, 1, 1) + timedelta(days=harvest_doy - 1)
-                            mgmt["Harvest date"] = f"0000-{d.month:02}-{d.day:02}"
-
-                valid_mgmt = False
-                if mgmt and shared.check_for_nill_dates(mgmt) and len(mgmt) > 1:
-                    valid_mgmt = True
-                    for ws in env_template["cropRotation"][0]["worksteps"]:
-                        if ws["type"] == "Sowing" and "Sowing date" in mgmt:
-                            ws["date"] = shared.mgmt_date_to_rel_date(mgmt["Sowing date"])
-                            if "Planting density" in mgmt:
-                                ws["PlantDensity"] = [float(mgmt["Planting density"]), "plants/m2"]
-                        elif ws["type"] == "Harvest" and "Harvest date" in mgmt:
-                            ws["date"] = shared.mgmt_date_to_rel_date(mgmt["Harvest date"])
-                        elif ws["type"] == "AutomaticHarvest" and "Harvest date" in mgmt:
-                            ws["latest-date"] = shared.mgmt_date_to_rel_date(mgmt["Harvest date"])
-                        elif ws["type"] == "Tillage" and "Tillage date" in mgmt:
-                            ws["date"] = shared.mgmt_date_to_rel_date(mgmt["Tillage date"])
-                        elif ws["type"] == "MineralFertilization":
-                            app_no = int(ws["application"])
-                            app_str = str(app_no) + ["st", "nd", "rd", "th"][app_no - 1]
-                            name = f"N {app_str} date"
-                            if name in mgmt:
-                                ws["date"] = shared.mgmt_date_to_rel_date(mgmt[name])
-                                ws["amount"] = [float(mgmt[f"N {app_str} application (kg/ha)"]), "kg"]
+                    mgmt = management[aer]
                 else:
-                    mgmt = None
-
-                def send_nodata_msg(sec):
-                    env_template["customId"] = {
-                        "setup_id": setup_id,
-                        "lat": lat, "lon": lon,
-                        "b_lat_0": b_lat_0, "b_lon_0": b_lon_0,
-                        "s_resolution": s_resolution,
-                        "s_row": s_row, "s_col": s_col,
-                        "s_row_0": s_row_0, "s_col_0": s_col_0,
-                        "no_of_s_cols": no_of_lons, "no_of_s_rows": no_of_lats,
-                        "c_row": int(c_row), "c_col": int(c_col),
-                        "env_id": sec + 1,
-                        "planting": planting,
-                        "nitrogen": nitrogen,
-                        "region": region,
-                        "crop": crop,
-                        "nodata": True,
-                        "aer": str(aer) if aer else "none",
+                    planting_doy = cells["planting_doy"][i]
+                    harvest_doy = cells["harvest_doy"][i]
+                    mgmt = {
+                        "Sowing date": shared.doy_to_rel_date(planting_doy),
+                        "Harvest date": shared.doy_to_rel_date(harvest_doy)
                     }
-                    socket.send_json(env_template)
-                    print("sent nodata env ", sec, " customId: ", env_template["customId"])
 
-                if mgmt is None or not valid_mgmt:
-                    send_nodata_msg(sent_envs_count)
-                    sent_envs_count += 1
-                    continue
-
-                soil_profile = global_soil_dataset.create_soil_profile(s_row, s_col)
+                for ws in env_template["cropRotation"][0]["worksteps"]:
+                    if ws["type"] == "Sowing" and "Sowing date" in mgmt:
+                        ws["date"] = shared.mgmt_date_to_rel_date(mgmt["Sowing date"])
+                        if "Planting density" in mgmt:
+                            ws["PlantDensity"] = [float(mgmt["Planting density"]), "plants/m2"]
+                    elif ws["type"] == "Harvest" and "Harvest date" in mgmt:
+                        ws["date"] = shared.mgmt_date_to_rel_date(mgmt["Harvest date"])
+                    elif ws["type"] == "AutomaticHarvest" and "Harvest date" in mgmt:
+                        ws["latest-date"] = shared.mgmt_date_to_rel_date(mgmt["Harvest date"])
+                    elif ws["type"] == "Tillage" and "Tillage date" in mgmt:
+                        ws["date"] = shared.mgmt_date_to_rel_date(mgmt["Tillage date"])
+                    elif ws["type"] == "MineralFertilization":
+                        app_no = int(ws["application"])
+                        app_str = str(app_no) + ["st", "nd", "rd", "th"][app_no - 1]
+                        name = f"N {app_str} date"
+                        if name in mgmt:
+                            ws["date"] = shared.mgmt_date_to_rel_date(mgmt[name])
+                            ws["amount"] = [float(mgmt[f"N {app_str} application (kg/ha)"]), "kg"]
+                stats.lap("env")
+
+                row_soil_profiles = soil_profiles.setdefault(s_row, {})
+                if s_col not in row_soil_profiles:
+                    row_soil_profiles[s_col] = global_soil_dataset.create_soil_profile(s_row, s_col)
+                soil_profile = row_soil_profiles[s_col]
+                stats.lap("soil")
                 if not soil_profile:
-                    send_nodata_msg(sent_envs_count)
-                    sent_envs_count += 1
-                    continue
-
-                dem_col = int((lon - dem_ll0r["lon_0"]) / dem_ll0r["res"])
-                dem_row = int((dem_ll0r["lat_0"] - lat) / dem_ll0r["res"])
-                height_nn = dem_grid[dem_row, dem_col]
-                if "nodata_value" in dem_metadata and height_nn == dem_metadata["nodata_value"]:
-                    send_nodata_msg(sent_envs_count)
-                    sent_envs_count += 1
+                    stats.skip("soil")
+                    soil_nodata_cols[r].append(c)
                     continue
 
-                slope_col = int((lon - slope_ll0r["lon_0"]) / slope_ll0r["res"])
-                slope_row = int((slope_ll0r["lat_0"] - lat) / slope_ll0r["res"])
-                slope = slope_grid[slope_row, slope_col]
-                if slope == slope_metadata["nodata_value"]:
-                    slope = 0
+                height_nn = cells["height_nn"][i]
+                slope = cells["slope"][i]
 
                 env_template["params"]["userCropParameters"]["__enable_T_response_leaf_expansion__"] = setup[
                     "LeafExtensionModifier"]
@@ -420,6 +542,8 @@ def run_producer(server={"server": None, "port": None}):
                 env_template["params"]["simulationParameters"]["EmergenceFloodingControlOn"] = setup[
                     "EmergenceFloodingControlOn"]
 
+                stats.lap("env")
+
                 env_template["csvViaHeaderOptions"] = sim_json["climate.csv-options"]
                 hist_sub_path = "isimip/3b_v1.1_CMIP6/csvs/{gcm}/historical/{ensmem}/row-{crow}/col-{ccol}.csv.gz".format(
                     gcm=gcm, ensmem=ensmem, crow=c_row, ccol=c_col)
@@ -427,63 +551,115 @@ def run_producer(server={"server": None, "port": None}):
                     gcm=gcm, scenario=scenario, ensmem=ensmem, crow=c_row, ccol=c_col
                 )
                 if setup["incl_historical"] and scenario != "historical":
-                    climate_data_paths = [
-                        paths["monica-path-to-climate-dir"] + hist_sub_path,
-                        paths["monica-path-to-climate-dir"] + sub_path
-                    ]
+                    climate_sub_paths = [hist_sub_path, sub_path]
                 else:
-                    climate_data_paths = [paths["monica-path-to-climate-dir"] + sub_path]
-                env_template["pathToClimateCSV"] = climate_data_paths
-                print("pathToClimateCSV:", env_template["pathToClimateCSV"])
+                    climate_sub_paths = [sub_path]
+                climate_data_paths = [paths["monica-path-to-climate-dir"] + p for p in climate_sub_paths]
+                if config["inline_climate"]:
+                    # read the climate cell once here instead of in every worker and send the data with the env
+                    env_template["climateData"] = climate_data_cache.climate_data(
+                        (gcm, scenario, ensmem, c_row, c_col, len(climate_sub_paths)),
+                        [paths["path-to-climate-dir"] + p for p in climate_sub_paths],
+                        sim_json["climate.csv-options"])
+                    env_template["pathToClimateCSV"] = ""
+                else:
+                    env_template["pathToClimateCSV"] = climate_data_paths
+                if dry_run:
+                    dry_run.touch_climate(climate_data_paths)
+                stats.lap("climate")
+
+                if dedup_envs:
+                    # the army worm consumer counts the histograms of a cell by its aer
+                    h = shared.env_hash(env_template, climate_data_paths, [str(aer) if aer else "none"])
+                    stats.lap("dedup")
+                    if h in env_hash_to_cell:
+                        stats.skip("dedup")
+                        fanout_cells[r].append([s_row, s_col, *env_hash_to_cell[h]])
+                        continue
+                    env_hash_to_cell[h] = (s_row, s_col)
 
                 env_template["customId"] = {
                     "setup_id": setup_id,
-                    "lat": lat,
-                    "lon": lon,
-                    "s_lat_0": s_lat_0,
-                    "s_lon_0": s_lon_0,
-                    "s_resolution": s_resolution,
-                    "s_row": s_row,
-                    "s_col": s_col,
-                    "s_row_0": s_row_0,
-                    "s_col_0": s_col_0,
-                    "no_of_s_cols": no_of_lons,
-                    "no_of_s_rows": no_of_lats,
-                    "c_row": int(c_row),
-                    "c_col": int(c_col),
-                    "env_id": sent_envs_count + 1,
-                    "planting": planting,
-                    "nitrogen": nitrogen,
-                    "region": region,
-                    "crop": crop,
+                    "s_row": s_row, "s_col": s_col,
+                    "env_id": shared.env_id(sent_envs_count, shard, no_of_shards),
                     "nodata": False,
                     "aer": str(aer) if aer else "none",
+                    "shard": shard,
                 }
-
-                socket.send_json(env_template)
-                print("sent env ", sent_envs_count+1, " customId: ", env_template["customId"])
+                if dedup_envs:
+                    env_template["customId"]["dedup_rows"] = dedup_rows
+
+                if credits:
+                    credits.acquire()
+                    stats.lap("wait")
+                env_template["customId"]["sent"] = time.time()  # for the latency tracing of the consumer
+                if config["fast_env_encoding"]:
+                    if not env_encoder:
+                        env_encoder = shared.EnvEncoder(env_template, shared.env_cell_paths(
+                            env_template, crop_varies=bool(setup["FieldConditionModifier"])))
+                    encoded_env = env_encoder.encode(env_template)
+                else:
+                    encoded_env = json.dumps(env_template).encode("utf8")  # as send_json does
+                stats.lap("encode")
+                sockets[shared.climate_cell_endpoint(c_row, c_col, len(sockets))].send(encoded_env, copy=False)
+                stats.lap("send")
+                stats.count("sent")
+                if stats.sample():
+                    print("sent env ", env_template["customId"]["env_id"], " customId: ", env_template["customId"],
+                          " pathToClimateCSV: ", env_template["pathToClimateCSV"])
+                stats.tick()
 
                 sent_envs_count += 1
+                row_to_count[r] += 1
 
-            #if sent_env_count > 300:
-            #    break
+            for r in rows:
+                no_of_cells = send_nodata(r, [(c, 1) for c in soil_nodata_cols[r]]) + send_fanout(fanout_cells[r])
+                sent_envs_count += no_of_cells
+                journal.append({"setup_id": setup_id, "row": plan["s_rows"][r],
+                                "envs": row_to_count[r] + no_of_cells})
+            yield
 
         # send the number of envs the consumer has to receive
         if env_template:
             env_template["pathToClimateCSV"] = ""
+            env_template.pop("climateData", None)
             env_template["customId"] = {
                 "setup_id": setup_id,
                 "no_of_sent_envs": sent_envs_count,
+                "no_of_shards": no_of_shards,
                 "nodata": True
             }
+            if credits:
+                credits.acquire()
             socket.send_json(env_template)
 
         stop_setup_time = time.perf_counter()
         print("Setup ", (sent_envs_count - 1), " envs took ", (stop_setup_time - start_setup_time), " seconds")
+        if config["inline_climate"]:
+            print("climate cache hits: ", climate_data_cache.hits, " misses: ", climate_data_cache.misses)
+        if credits:
+            print("flow control: ", credits.metrics())
 
         all_sent_envs_count += sent_envs_count
 
+    # run calculations for each setup
+    if config["sweep_setups"]:
+        # advance the setups row group by row group, so the cell data shared by them is computed once
+        for _ in zip_longest(*[run_setup(setup_id) for setup_id in run_setups]):
+            pass
+    else:
+        for setup_id in run_setups:
+            for _ in run_setup(setup_id):
+                pass
+
     stop_time = time.perf_counter()
+    stats.write_report(config["stats_report"] + (f".shard-{shard}" if no_of_shards > 1 else ""))
+    if dry_run:
+        dry_run.switch_to(None)
+        dry_run.print_report(stats.stage_to_secs["encode"])
+    for socket_ in sockets + [nodata_socket, credits.socket if credits else None]:
+        if socket_:
+            socket_.close()
 
     # write summary of used json files
     try:
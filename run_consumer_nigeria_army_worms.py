@@ -15,7 +15,7 @@
 # Landscape Systems Analysis at the ZALF.
 # Copyright (C: Leibniz Centre for Agricultural Landscape Research (ZALF)
 
-from collections import defaultdict
+from collections import defaultdict, deque
 import csv
 import numpy as np
 import os
@@ -286,6 +286,15 @@ def calculate_index_data(data_sections, aer):
     return cm_count_to_vals, aer_to_year_to_week_to_histogram_data
 
 
+def decode_index_data(msg):
+    """calculate_index_data of a message in the processes of a shared.DecodePool, with the histogram data as plain
+    dicts, so it can be sent back"""
+    grid_data, histogram_data = calculate_index_data(msg.get("data", []), msg["customId"]["aer"])
+    return grid_data, {aer: {year: {week: dict(hist) for week, hist in week_to_hist.items()}
+                             for year, week_to_hist in year_to_week_to_hist.items()}
+                       for aer, year_to_week_to_hist in histogram_data.items()}
+
+
 def write_row_to_grids(row_col_data, row, col_0, no_of_cols, header, path_to_output_dir, setup_id):
     """write grids row by row"""
 
@@ -367,20 +376,14 @@ def write_row_to_grids(row_col_data, row, col_0, no_of_cols, header, path_to_out
     if is_no_data_row:
         write_row_to_grids.nodata_row_count[setup_id] += 1
 
-    def write_nodata_rows(file_):
-        for _ in range(write_row_to_grids.nodata_row_count[setup_id]):
-            rowstr = " ".join(["-9999" for __ in range(no_of_cols)])
-            file_.write(rowstr + "\n")
+    # the nodata rows pending, they are written in front of the row
+    nodata_rows = shared.nodata_grid_line(no_of_cols) * write_row_to_grids.nodata_row_count[setup_id]
 
     # iterate over all prepared data for a single row and write row
     for key, y2d_ in output_grids.items():
         y2d = y2d_["data"]
         cast_to = y2d_["cast-to"]
         digits = y2d_.get("digits", 0)
-        if cast_to == "int":
-            mold = lambda x: str(int(x))
-        else:
-            mold = lambda x: str(round(x, digits))
 
         for (cm_count, year), row_arr in y2d.items():
             crop = cmc_to_crop[cm_count] if cm_count in cmc_to_crop else "none"
@@ -393,9 +396,7 @@ def write_row_to_grids(row_col_data, row, col_0, no_of_cols, header, path_to_out
                     write_row_to_grids.list_of_output_files[setup_id].append(path_to_file)
 
             with open(path_to_file, "a") as file_:
-                write_nodata_rows(file_)
-                rowstr = " ".join(["-9999" if int(x) == -9999 else mold(x) for x in row_arr])
-                file_.write(rowstr + "\n")
+                file_.write(nodata_rows + shared.format_grid_row(row_arr, cast_to, digits) + "\n")
 
     # clear the no-data row count when no-data rows have been written before a data row
     if not is_no_data_row:
@@ -409,7 +410,7 @@ def write_row_to_grids(row_col_data, row, col_0, no_of_cols, header, path_to_out
             and write_row_to_grids.nodata_row_count[setup_id] > 0:
         for path_to_file in write_row_to_grids.list_of_output_files[setup_id]:
             with open(path_to_file, "a") as file_:
-                write_nodata_rows(file_)
+                file_.write(nodata_rows)
         write_row_to_grids.nodata_row_count[setup_id] = 0
 
     if row in row_col_data:
@@ -423,7 +424,16 @@ def run_consumer(leave_after_finished_run=True, server={"server": None, "port":
         "mode": "mbm-local-remote",
         "port": server["port"] if server["port"] else "7777",  # local 7778,  remote 7777
         "server": server["server"] if server["server"] else "login01.cluster.zalf.de",
-        "timeout": 600000*3  # 30 minutes
+        "timeout": 600000*3,  # 30 minutes
+        "nodata-port": "",  # if set, receive the nodata cells directly from the producer on this port
+        "endpoints": "",  # host:port,... of several proxies to collect the results from instead of server:port
+        "feedback-port": "",  # if set, report the results received to the producer (credit based flow control)
+        "feedback_interval": "1000",  # ms between the reports
+        "latency_metrics": "",  # if set, write the latency histograms and setup throughput to this .json or .csv file
+        "metrics-port": "",  # if set, serve the latency metrics as prometheus text on this port
+        "metrics_interval": "30",  # seconds between the updates of the metrics
+        "decode_workers": "0",  # if > 0, calculate the index data in this many processes, see shared.DecodePool
+        "decode_queue": "1000",  # max results received but not written yet with decode_workers
     }
 
     shared.update_config(config, sys.argv, print_config=True, allow_new_keys=False)
@@ -438,8 +448,30 @@ def run_consumer(leave_after_finished_run=True, server={"server": None, "port":
     context = zmq.Context()
     socket = context.socket(zmq.PULL)
 
-    socket.connect("tcp://" + config["server"] + ":" + config["port"])
+    # collect the results of several proxies (see endpoints of the producer)
+    for endpoint in (config["endpoints"].split(",") if config["endpoints"]
+                     else [config["server"] + ":" + config["port"]]):
+        socket.connect("tcp://" + endpoint)
     socket.RCVTIMEO = config["timeout"]
+    poller = zmq.Poller()
+    poller.register(socket, zmq.POLLIN)
+    # side channel for the nodata cells sent by the producer directly
+    if config["nodata-port"]:
+        nodata_socket = context.socket(zmq.PULL)
+        nodata_socket.bind("tcp://*:" + config["nodata-port"])
+        poller.register(nodata_socket, zmq.POLLIN)
+    # the producer paces the envs by the results reported here
+    feedback = None
+    if config["feedback-port"]:
+        feedback_socket = context.socket(zmq.PUB)
+        feedback_socket.bind("tcp://*:" + config["feedback-port"])
+        feedback = shared.FeedbackReporter(feedback_socket, int(config["feedback_interval"]))
+    # time the envs spend in the proxy queue and on MONICA and the results waiting for their row
+    latency = None
+    if config["latency_metrics"] or config["metrics-port"]:
+        latency = shared.LatencyTracker(config["latency_metrics"], float(config["metrics_interval"]))
+        if config["metrics-port"]:
+            latency.serve(config["metrics-port"])
     leave = False
 
     setup_id_to_data = defaultdict(lambda: {
@@ -451,7 +483,11 @@ def run_consumer(leave_after_finished_run=True, server={"server": None, "port":
         "cols@row_received": {},
         "next_row": None,
         "no_of_envs_expected": None,
+        "sent_envs_counts": [],
         "envs_received": 0,
+        "dedup_results": defaultdict(dict),  # row -> col -> result of an env sent for other cells too
+        "dedup_waiting": defaultdict(list),  # (row, col) of the sent env -> cells waiting for its result
+        "dedup_rows": 0,
     })
 
     aer_to_year_to_week_to_histogram_data = defaultdict(  # aer
@@ -462,12 +498,52 @@ def run_consumer(leave_after_finished_run=True, server={"server": None, "port":
         )
     )
     cached_hist_data = []
+    # the setup metadata, the producer sends it once per setup instead of with every env
+    setup_registry = shared.SetupRegistry()
+    ready_msgs = deque()
+
+    def backlog():
+        """the cells received, but waiting for their row to be complete"""
+        return sum(data["cols@row_received"].get(row, 0)
+                   for data in setup_id_to_data.values() for row in data["row_col_data"])
+
+    # receive the results and calculate the index data in other processes, this one just writes
+    pool = None
+    if int(config["decode_workers"]) > 0:
+        pool = shared.DecodePool(poller, socket, decode_index_data, int(config["decode_workers"]),
+                                 int(config["decode_queue"]))
 
     while True:
         try:
-            msg = socket.recv_json()  # encoding="latin-1"
+            if not ready_msgs:
+                # with flow control, wake up to report even if no messages come in
+                timeout_ms = feedback.interval_ms if feedback else int(config["timeout"])
+                msg, from_monica = None, False
+                if pool:
+                    msg, from_monica = pool.get(timeout_ms)
+                else:
+                    socks = dict(poller.poll(timeout_ms))
+                    if socks:
+                        # prefer the results from MONICA, the nodata side channel is polled again in the next round
+                        sock = socket if socket in socks else next(iter(socks))
+                        msg, from_monica = sock.recv_json(), sock is socket  # encoding="latin-1"
+                if feedback:
+                    feedback.report(backlog)
+                if latency:
+                    if pool:
+                        latency.gauge("decode_queue_depth", pool.depth())
+                    latency.tick()
+                if msg is None:
+                    if feedback and feedback.idle_ms() < int(config["timeout"]):
+                        continue
+                    raise zmq.error.Again()
+                if feedback:
+                    feedback.message_received(from_monica=from_monica)
+                ready_msgs.extend(setup_registry.resolve(msg))
+                continue
+            msg = ready_msgs.popleft()
 
-            if len(msg["errors"]) > 0:
+            if len(msg.get("errors", [])) > 0:
                 print("There were errors in message:", msg, "\nSkipping message!")
                 continue
 
@@ -476,22 +552,20 @@ def run_consumer(leave_after_finished_run=True, server={"server": None, "port":
             data = setup_id_to_data[setup_id]
 
             if "no_of_sent_envs" in custom_id:
-                data["no_of_envs_expected"] = custom_id["no_of_sent_envs"]
+                # a sharded producer sends one count per shard
+                data["sent_envs_counts"].append(custom_id["no_of_sent_envs"])
+                if len(data["sent_envs_counts"]) == custom_id.get("no_of_shards", 1):
+                    data["no_of_envs_expected"] = sum(data["sent_envs_counts"])
             else:
                 region = custom_id["region"]
                 planting = custom_id["planting"]
                 nitrogen = custom_id["nitrogen"]
                 crop = custom_id["crop"]
-                aer = custom_id["aer"]
 
-                row = custom_id["s_row"]
-                col = custom_id["s_col"]
                 no_of_cols = custom_id["no_of_s_cols"]
                 no_of_rows = custom_id["no_of_s_rows"]
                 row_0 = custom_id["s_row_0"]
                 col_0 = custom_id["s_col_0"]
-                if row not in data["cols@row_received"]:
-                    data["cols@row_received"][row] = 0
                 if data["next_row"] is None:
                     data["next_row"] = row_0
                 if data["header"] is None:
@@ -504,24 +578,65 @@ def run_consumer(leave_after_finished_run=True, server={"server": None, "port":
                         f"cellsize     {custom_id['s_resolution']}\n" + \
                         f"NODATA_value -9999\n"
 
-                is_nodata = custom_id["nodata"]
-
-                debug_msg = f"received work result {data['envs_received']} " + \
-                            f"customId: {msg.get('customId', '')} " + \
-                            f"next row: {data['next_row']} " + \
-                            f"cols@row to go: {no_of_cols - data['cols@row_received'][row]}@{row} " + \
-                            f"cols_per_row: {no_of_cols}"
-                print(debug_msg)
-                # debug_file.write(debug_msg + "\n")
-                if is_nodata:
-                    data["row_col_data"][row][col] = -9999
+                def add_copied_result(row_, col_, result):
+                    # result of an identical env sent for another cell
+                    grid_data_, histogram_data_ = result
+                    cached_hist_data.append(histogram_data_)
+                    data["row_col_data"][row_][col_].append(grid_data_)
+                    data["cols@row_received"][row_] = data["cols@row_received"].get(row_, 0) + 1
+                    data["envs_received"] += 1
+
+                if "nodata_ranges" in msg:
+                    # nodata cells sent directly by the producer, they just have to be counted
+                    for row, col, no_of_nodata_cols in msg["nodata_ranges"]:
+                        data["row_col_data"][row]  # make sure the row exists, missing cols are written as nodata
+                        data["cols@row_received"][row] = data["cols@row_received"].get(row, 0) + no_of_nodata_cols
+                        data["envs_received"] += no_of_nodata_cols
+                    print(f"received nodata ranges: {msg['nodata_ranges']} next row: {data['next_row']}")
+                elif "fanout" in msg:
+                    # cells getting the result of an identical env sent for another cell
+                    data["dedup_rows"] = custom_id["dedup_rows"]
+                    for row, col, env_row, env_col in msg["fanout"]:
+                        result = data["dedup_results"].get(env_row, {}).get(env_col)
+                        if result is None:
+                            data["dedup_waiting"][(env_row, env_col)].append((row, col))
+                        else:
+                            add_copied_result(row, col, result)
+                    print(f"received fanout: {msg['fanout']} next row: {data['next_row']}")
                 else:
-                    grid_data, histogram_data = calculate_index_data(msg.get("data", []), aer)
-                    cached_hist_data.append(histogram_data)
-                    data["row_col_data"][row][col].append(grid_data)
-                data["cols@row_received"][row] += 1
-
-                data["envs_received"] += 1
+                    aer = custom_id["aer"]
+                    row = custom_id["s_row"]
+                    col = custom_id["s_col"]
+                    if row not in data["cols@row_received"]:
+                        data["cols@row_received"][row] = 0
+
+                    is_nodata = custom_id["nodata"]
+                    if latency:
+                        latency.received(custom_id)
+
+                    debug_msg = f"received work result {data['envs_received']} " + \
+                                f"customId: {msg.get('customId', '')} " + \
+                                f"next row: {data['next_row']} " + \
+                                f"cols@row to go: {no_of_cols - data['cols@row_received'][row]}@{row} " + \
+                                f"cols_per_row: {no_of_cols}"
+                    print(debug_msg)
+                    # debug_file.write(debug_msg + "\n")
+                    if is_nodata:
+                        data["row_col_data"][row][col] = -9999
+                    else:
+                        grid_data, histogram_data = msg["decoded"] if "decoded" in msg \
+                            else calculate_index_data(msg.get("data", []), aer)
+                        cached_hist_data.append(histogram_data)
+                        data["row_col_data"][row][col].append(grid_data)
+                        if "dedup_rows" in custom_id:
+                            # keep the result for the cells with an identical env
+                            data["dedup_rows"] = custom_id["dedup_rows"]
+                            data["dedup_results"][row][col] = (grid_data, histogram_data)
+                            for row_, col_ in data["dedup_waiting"].pop((row, col), []):
+                                add_copied_result(row_, col_, (grid_data, histogram_data))
+                    data["cols@row_received"][row] += 1
+
+                    data["envs_received"] += 1
 
                 while (data["next_row"] in data["row_col_data"] and
                        data["cols@row_received"][data["next_row"]] == no_of_cols):
@@ -537,6 +652,10 @@ def run_consumer(leave_after_finished_run=True, server={"server": None, "port":
 
                     write_row_to_grids(data["row_col_data"], data["next_row"], col_0, no_of_cols,
                                        data["header"], path_to_out_dir, setup_id)
+                    if feedback:
+                        feedback.committed += no_of_cols
+                    if latency:
+                        latency.committed(setup_id, data["next_row"])
 
                     debug_msg = "wrote row: " + str(data["next_row"]) \
                                 + " next_row: " + str(data["next_row"] + 1) \
@@ -545,6 +664,10 @@ def run_consumer(leave_after_finished_run=True, server={"server": None, "port":
 
                     data["next_row"] += 1  # move to next row (to be written)
 
+                    # no cell from here on can share an env with the rows left behind by more than dedup_rows
+                    for env_row in [r for r in data["dedup_results"] if r < data["next_row"] - data["dedup_rows"]]:
+                        del data["dedup_results"][env_row]
+
             # this setup is finished
             if data["no_of_envs_expected"] and data["no_of_envs_expected"] == data["envs_received"]:
 
@@ -590,11 +713,19 @@ def run_consumer(leave_after_finished_run=True, server={"server": None, "port":
                     break
 
         except zmq.error.Again as _e:
+            if latency:
+                latency.tick(force=True)
+            if pool:
+                pool.close()
             print('no response from the server (with "timeout"=%d ms) ' % socket.RCVTIMEO)
             return
         except Exception as e:
             print("Exception:", e)
 
+    if latency:
+        latency.tick(force=True)
+    if pool:
+        pool.close()
     print("exiting run_consumer()")
 
 
@@ -15,9 +15,107 @@
 # Landscape Systems Analysis at the ZALF.
 # Copyright (C: Leibniz Centre for Agricultural Landscape Research (ZALF)
 
+from collections import defaultdict, OrderedDict
+from bisect import bisect_left, bisect_right
+import concurrent.futures
+import csv
+from datetime import date, datetime, timedelta
+from functools import lru_cache
+import gzip
+from itertools import groupby
+import hashlib
+import heapq
+import http.server
+import json
+import multiprocessing
 from netCDF4 import Dataset
 import monica_run_lib
 import numpy as np
+import os
+import queue
+import sys
+import threading
+import time
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+REGION_TO_LAT_LON_BOUNDS = {
+    "nigeria": {"tl": {"lat": 14.0, "lon": 2.7}, "br": {"lat": 4.25, "lon": 14.7}},
+    "africa": {"tl": {"lat": 37.4, "lon": -17.55}, "br": {"lat": -34.9, "lon": 51.5}},
+    "earth": {
+        "5min": {"tl": {"lat": 83.95833588, "lon": -179.95832825},
+                 "br": {"lat": -55.95833206, "lon": 179.50000000}},
+        "30sec": {"tl": {"lat": 83.99578094, "lon": -179.99583435},
+                  "br": {"lat": -55.99583435, "lon": 179.99568176}}
+    }
+}
+
+# per consumer type the outputs written as grids (name: cast-to, digits) and the keys create_output needs besides,
+# the producers trim the events of the envs to them (output_spec), so MONICA doesn't compute and send the rest
+OUTPUT_SPECS = {
+    "africa": {
+        "grids": {
+            "Yield": ("float", 2),
+            "TraDef": ("float", 2),
+            # "AbBiom": ("float", 2),
+            # "LAI": ("float", 2),
+            # "tradefavg": ("float", 2),
+            # "heatredavg": ("float", 2),
+            # "frostredavg": ("float", 2),
+        },
+        "keys": ["CM-count", "Year", "Crop", "Date"]
+    },
+    "nigeria": {
+        "grids": {
+            "Yield": ("float", 2),
+            # "AbBiom": ("float", 2),
+            # "LAI": ("float", 2),
+            # "EmergDOY": ("int", 0),
+            "HarvDOY": ("int", 0),
+            # "tradefavg": ("float", 2),
+            # "heatredavg": ("float", 2),
+            # "frostredavg": ("float", 2),
+            "min_tmin": ("float", 2),
+            "avg_tmin": ("float", 2),
+            "avg_tavg": ("float", 2),
+            "max_tmax": ("float", 2),
+            "avg_tmax": ("float", 2),
+            "sum_precip": ("float", 2),
+            "avg_relhumid": ("float", 2),
+            # "avg_globrad": ("float", 2),
+        },
+        "keys": ["CM-count", "Year", "Crop"]
+    },
+    "calibration": {
+        "grids": {"Yield": ("float", 2)},
+        "keys": ["Year"]
+    },
+}
+
+# why a cell is sent as nodata, the first check a cell fails counts (see create_work_plan and EligibilityCache),
+# crop_mask is only checked by the calibration producer, create_work_plan of the africa and nigeria producers
+# never sets it, it keeps its place as the eligibility caches store the index
+ELIGIBILITY_REASONS = ("eligible", "mgmt", "crop_mask", "country", "dem", "soil")
+
+
+def output_name(output):
+    """the name an output of the events section shows up with in the results, e.g. HarvDOY for ["DOY|HarvDOY", ...]"""
+    return (output[0] if isinstance(output, list) else output).split("|")[-1]
+
+
+def trim_events(events, output_spec):
+    """keep only the outputs of the events named in the output spec,
+    sections left without any of the spec's grids are dropped completely"""
+    names = set(output_spec["grids"]) | set(output_spec["keys"])
+    trimmed = []
+    for section, outputs in zip(events[::2], events[1::2]):
+        outputs = [output for output in outputs if output_name(output) in names]
+        if any(output_name(output) in output_spec["grids"] for output in outputs):
+            trimmed.extend([section, outputs])
+    return trimmed
 
 
 def update_config(config, argv, print_config=False, allow_new_keys=False):
@@ -29,6 +127,24 @@ def update_config(config, argv, print_config=False, allow_new_keys=False):
         if print_config:
             print(config)
 
+
+def _run_shard(run_func, shard, args):
+    sys.argv.append(f"shard={shard}")
+    run_func(*args)
+
+
+def run_shards(run_func, no_of_shards, *args):
+    """run run_func(*args) in no_of_shards processes, each gets shard=<i> appended to its command line,
+    returns the exit codes of the processes"""
+    procs = [multiprocessing.Process(target=_run_shard, args=(run_func, shard, args))
+             for shard in range(no_of_shards)]
+    for proc in procs:
+        proc.start()
+    for proc in procs:
+        proc.join()
+    return [proc.exitcode for proc in procs]
+
+
 def get_lat_0_lon_0_resolution_from_grid_metadata(metadata):
     lat_0 = float(metadata["yllcorner"]) \
                 + (float(metadata["cellsize"]) * float(metadata["nrows"])) \
@@ -79,6 +195,24 @@ def mgmt_date_to_rel_date(mgmt_date):
     return f"0000-{month_str}-{int(day_str):02}"
 
 
+@lru_cache(maxsize=None)
+def doy_to_rel_date(doy, year_offset=0):
+    """day of year (of a non leap year) to a relative MONICA date, e.g. 32 -> 0000-02-01"""
+    d = date(2023, 1, 1) + timedelta(days=doy - 1)
+    return f"000{year_offset}-{d.month:02}-{d.day:02}"
+
+
+# order of the soil values of a layer in the soil catalog
+CATALOG_SOIL_ELEMS = ["corg", "bd", "sand", "clay"]
+
+SOIL_LAYERS = [(0, 4.5, 0), (1, 9.1, 0.1), (2, 16.6, 0.1), (3, 28.9, 0.1),
+               (4, 49.3, 0.2), (5, 82.9, 0.3), (6, 138.3, 0.6), (7, 229.6, 0.7)]
+
+
+def soil_catalog_path(path_to_data_dir, region, resolution):
+    return f"{path_to_data_dir}/soil-catalog_{region}_{resolution}"
+
+
 class GlobalSoilDataSet:
     """Global Soil Dataset for Earth System Modeling"""
     def __init__(self, path_to_soil_dir, resolution):
@@ -95,12 +229,152 @@ class GlobalSoilDataSet:
             self.soil_data = None  # ["Sand5min.nc", "Clay5min.nc", "OC5min.nc", "BD5min.nc"]
         self.soil_datasets = {}
         self.soil_vars = {}
+        self.paths = [path_to_soil_netcdfs + data["file"] for data in self.soil_data.values()]
         for elem, data in self.soil_data.items():
             ds = Dataset(path_to_soil_netcdfs + data["file"], "r", format="NETCDF4")
             self.soil_datasets[elem] = ds
             self.soil_vars[elem] = ds.variables[data["var"]]
+        self.window = None
+        self.catalog = None
+
+    def load_window(self, row_0, col_0, no_of_rows, no_of_cols):
+        """read the row/col window of all soil variables at once into memory and
+        derive the valid layer depth of every cell of the window"""
+        w = self.window
+        if w and (w["row_0"], w["col_0"], w["rows"], w["cols"]) == (row_0, col_0, no_of_rows, no_of_cols):
+            return
+
+        _, nrows, ncols = self.soil_vars["sand"].shape
+        r1 = min(row_0 + no_of_rows, nrows)
+        c1 = min(col_0 + no_of_cols, ncols)
+        no_of_rows = r1 - row_0
+        no_of_cols = c1 - col_0
+        data = {}
+        first_masked_layer = np.full((no_of_rows, no_of_cols), 8, dtype=int)
+        for elem, var in self.soil_vars.items():
+            arr = var[:8, row_0:r1, col_0:c1]
+            mask = np.ma.getmaskarray(arr)
+            first_masked_layer = np.minimum(first_masked_layer,
+                                            np.where(mask.any(axis=0), mask.argmax(axis=0), 8))
+            data[elem] = np.ma.getdata(arr)
+        self.window = {
+            "row_0": row_0, "col_0": col_0, "rows": no_of_rows, "cols": no_of_cols,
+            "data": data,
+            "layer_depth": first_masked_layer - 1,
+        }
+        print("read soil window rows:", row_0, "-", r1, "cols:", col_0, "-", c1)
+
+    def _create_soil_profile_from_window(self, row, col):
+        w = self.window
+        r = row - w["row_0"]
+        c = col - w["col_0"]
+        layer_depth = int(w["layer_depth"][r, c])
+        if layer_depth < 4:
+            return None
+
+        vals = {elem: (arr[:layer_depth + 1, r, c].tolist(), self.soil_data[elem]["conv_factor"])
+                for elem, arr in w["data"].items()}
+        layers = []
+        for i, real_depth_cm, monica_depth_m in SOIL_LAYERS[1:layer_depth + 1]:
+            layers.append({
+                "Thickness": [monica_depth_m, "m"],
+                "SoilOrganicCarbon": [float(vals["corg"][0][i]) * vals["corg"][1], "%"],
+                "SoilBulkDensity": [float(vals["bd"][0][i]) * vals["bd"][1], "kg m-3"],
+                "Sand": [float(vals["sand"][0][i]) * vals["sand"][1], "fraction"],
+                "Clay": [float(vals["clay"][0][i]) * vals["clay"][1], "fraction"]
+            })
+        return layers
+
+    def build_catalog(self, path_to_catalog, row_0, col_0, no_of_rows, no_of_cols):
+        """write a catalog of the unique soil profiles of a row/col window and a per cell index into it"""
+        self.load_window(row_0, col_0, no_of_rows, no_of_cols)
+        w = self.window
+        layer_depth = w["layer_depth"]
+        # per cell: layer depth + the converted values of the layers 1-7, unused layers are set to -1
+        values = np.stack([w["data"][elem][1:8].astype(float) * self.soil_data[elem]["conv_factor"]
+                           for elem in CATALOG_SOIL_ELEMS], axis=1)
+        used = np.arange(1, 8)[:, np.newaxis, np.newaxis] <= layer_depth
+        values = np.where(used[:, np.newaxis], values, -1.0)
+        cell_vecs = np.concatenate([layer_depth[np.newaxis].astype(float),
+                                    values.reshape(-1, w["rows"], w["cols"])]).reshape(29, -1).T
+
+        valid = layer_depth.ravel() >= 4
+        profiles, inverse = np.unique(cell_vecs[valid], axis=0, return_inverse=True)
+        index = np.full(w["rows"] * w["cols"], -1, dtype=np.int32)
+        index[valid] = inverse.ravel()
+
+        os.makedirs(path_to_catalog, exist_ok=True)
+        np.save(path_to_catalog + "/profiles.npy", profiles)
+        np.save(path_to_catalog + "/index.npy", index.reshape(w["rows"], w["cols"]))
+        with open(path_to_catalog + "/meta.json", "w") as _:
+            json.dump({"row_0": w["row_0"], "col_0": w["col_0"], "rows": w["rows"], "cols": w["cols"],
+                       "no_of_profiles": len(profiles)}, _)
+        print("wrote soil catalog:", path_to_catalog, "with", len(profiles), "unique profiles for",
+              int(valid.sum()), "of", len(index), "cells")
+
+    def load_catalog(self, path_to_catalog):
+        """memory map a soil catalog written by build_catalog"""
+        with open(path_to_catalog + "/meta.json") as _:
+            meta = json.load(_)
+        self.catalog = {
+            **meta,
+            "path": path_to_catalog,
+            "profiles": np.load(path_to_catalog + "/profiles.npy", mmap_mode="r"),
+            "index": np.load(path_to_catalog + "/index.npy", mmap_mode="r"),
+            "id_to_profile": {},
+        }
+        print("loaded soil catalog:", path_to_catalog)
+
+    def soil_profile_id(self, row, col):
+        """id of the cell's profile in the loaded catalog, cells with the same id have identical soil
+        (None if the cell has no valid soil profile or is not covered by the catalog)"""
+        cat = self.catalog
+        if cat and 0 <= row - cat["row_0"] < cat["rows"] and 0 <= col - cat["col_0"] < cat["cols"]:
+            profile_id = int(cat["index"][row - cat["row_0"], col - cat["col_0"]])
+            return profile_id if profile_id >= 0 else None
+        return None
+
+    def _create_soil_profile_from_catalog(self, profile_id):
+        id_to_profile = self.catalog["id_to_profile"]
+        if profile_id in id_to_profile:
+            return id_to_profile[profile_id]
+
+        vec = self.catalog["profiles"][profile_id].tolist()
+        layer_depth = int(vec[0])
+        layers = []
+        for i, real_depth_cm, monica_depth_m in SOIL_LAYERS[1:layer_depth + 1]:
+            corg, bd, sand, clay = vec[1 + (i - 1) * 4: 1 + i * 4]
+            layers.append({
+                "Thickness": [monica_depth_m, "m"],
+                "SoilOrganicCarbon": [corg, "%"],
+                "SoilBulkDensity": [bd, "kg m-3"],
+                "Sand": [sand, "fraction"],
+                "Clay": [clay, "fraction"]
+            })
+        id_to_profile[profile_id] = layers
+        return layers
+
+    def has_soil_profile(self, row, col):
+        """if the cell has a valid soil profile, without creating it if the catalog or window cover the cell"""
+        cat = self.catalog
+        if cat and 0 <= row - cat["row_0"] < cat["rows"] and 0 <= col - cat["col_0"] < cat["cols"]:
+            return self.soil_profile_id(row, col) is not None
+        w = self.window
+        if w and 0 <= row - w["row_0"] < w["rows"] and 0 <= col - w["col_0"] < w["cols"]:
+            return int(w["layer_depth"][row - w["row_0"], col - w["col_0"]]) >= 4
+        return bool(self.create_soil_profile(row, col))
 
     def create_soil_profile(self, row, col):
+        cat = self.catalog
+        if cat and 0 <= row - cat["row_0"] < cat["rows"] and 0 <= col - cat["col_0"] < cat["cols"]:
+            # profiles from the catalog are shared between cells with identical soil, don't modify them
+            profile_id = self.soil_profile_id(row, col)
+            return None if profile_id is None else self._create_soil_profile_from_catalog(profile_id)
+
+        w = self.window
+        if w and 0 <= row - w["row_0"] < w["rows"] and 0 <= col - w["col_0"] < w["cols"]:
+            return self._create_soil_profile_from_window(row, col)
+
         # skip first 4.5cm layer and just use 7 layers
         layers = []
 
@@ -118,8 +392,7 @@ class GlobalSoilDataSet:
         if layer_depth < 4:
             return None
 
-        for i, real_depth_cm, monica_depth_m in [(0, 4.5, 0), (1, 9.1, 0.1), (2, 16.6, 0.1), (3, 28.9, 0.1),
-                                                 (4, 49.3, 0.2), (5, 82.9, 0.3), (6, 138.3, 0.6), (7, 229.6, 0.7)][1:]:
+        for i, real_depth_cm, monica_depth_m in SOIL_LAYERS[1:]:
             if i <= layer_depth:
                 layers.append({
                     "Thickness": [monica_depth_m, "m"],
@@ -131,6 +404,18 @@ class GlobalSoilDataSet:
         return layers
 
 
+def global_soil_dataset_cached(path_to_soil_dir, resolution):
+    """the soil dataset opened once per process, so a resident producer (run-producer-daemon.py) keeps the
+    netcdf handles and the window or catalog read last"""
+    if not hasattr(global_soil_dataset_cached, "cache"):
+        global_soil_dataset_cached.cache = {}
+
+    key = (path_to_soil_dir, resolution)
+    if key not in global_soil_dataset_cached.cache:
+        global_soil_dataset_cached.cache[key] = GlobalSoilDataSet(path_to_soil_dir, resolution)
+    return global_soil_dataset_cached.cache[key]
+
+
 def load_grid_cached(path_to_grid, val_type, print_path=False):
     if not hasattr(load_grid_cached, "cache"):
         load_grid_cached.cache = {}
@@ -139,7 +424,7 @@ def load_grid_cached(path_to_grid, val_type, print_path=False):
         return load_grid_cached.cache[path_to_grid]
 
     md, _ = monica_run_lib.read_header(path_to_grid)
-    grid = np.loadtxt(path_to_grid, dtype=type, skiprows=len(md))
+    grid = np.loadtxt(path_to_grid, dtype=val_type, skiprows=len(md))
     print("read: ", path_to_grid)
     ll0r = get_lat_0_lon_0_resolution_from_grid_metadata(md)
 
@@ -159,7 +444,7 @@ def load_grid_cached(path_to_grid, val_type, print_path=False):
         return None
 
     cache_entry = {
-        "metadata": md, "grid": grid, "ll0r": ll0r,
+        "path": path_to_grid, "metadata": md, "grid": grid, "ll0r": ll0r,
         "col": lambda lon: col(lon),
         "row": lambda lat: row(lat),
         "value": lambda lat, lon, ret_no_data: value(lat, lon, ret_no_data)
@@ -167,3 +452,1469 @@ def load_grid_cached(path_to_grid, val_type, print_path=False):
     load_grid_cached.cache[path_to_grid] = cache_entry
     return cache_entry
 
+
+
+def grid_values(grid_data, lats, lons, fill_value=None):
+    """vectorized value lookup in a (cached) grid, lats and lons are broadcast against each other,
+    returns the values (fill_value or nodata outside the grid) and the in-bounds mask"""
+    md = grid_data["metadata"]
+    ll0r = grid_data["ll0r"]
+    rows = ((ll0r["lat_0"] - np.asarray(lats)) / ll0r["res"]).astype(int)
+    cols = ((np.asarray(lons) - ll0r["lon_0"]) / ll0r["res"]).astype(int)
+    rows, cols = np.broadcast_arrays(rows, cols)
+    in_bounds = (0 <= rows) & (rows < int(md["nrows"])) & (0 <= cols) & (cols < int(md["ncols"]))
+    grid = grid_data["grid"]
+    vals = np.full(rows.shape, md.get("nodata_value", -9999) if fill_value is None else fill_value, dtype=grid.dtype)
+    vals[in_bounds] = grid[rows[in_bounds], cols[in_bounds]]
+    return vals, in_bounds
+
+
+def bounding_box_lats_lons(lat_lon_bounds, s_resolution, s_res_scale_factor):
+    """the cell center lats (top to bottom) and lons (left to right) of a bounding box"""
+    lats_scaled = np.arange(int(lat_lon_bounds["tl"]["lat"] * s_res_scale_factor),
+                            int(lat_lon_bounds["br"]["lat"] * s_res_scale_factor) - 1,
+                            -int(s_resolution * s_res_scale_factor))
+    lons_scaled = np.arange(int(lat_lon_bounds["tl"]["lon"] * s_res_scale_factor),
+                            int(lat_lon_bounds["br"]["lon"] * s_res_scale_factor) + 1,
+                            int(s_resolution * s_res_scale_factor))
+    return lats_scaled / s_res_scale_factor, lons_scaled / s_res_scale_factor
+
+
+def true_runs(mask):
+    """start index and length of the runs of True values in a 1D bool array"""
+    edges = np.flatnonzero(np.diff(np.concatenate([[False], mask, [False]]).astype(np.int8)))
+    return list(zip(edges[::2].tolist(), (edges[1::2] - edges[::2]).tolist()))
+
+
+def create_work_plan(lat_lon_bounds, s_lat_0, s_lon_0, s_resolution, s_res_scale_factor,
+                     c_lat_0=89.25, c_lon_0=-179.75, c_resolution=0.5,
+                     eco_data=None, valid_aers=None, planting_data=None, harvest_data=None,
+                     dem_data=None, slope_data=None, country_id_data=None, only_country_ids=None):
+    """compile the cell sweep of a setup in one vectorized pass
+
+    Returns the coordinates and indices of the rows and cols of the bounding box, the eligibility mask
+    (management, dem and country checks), the reason of the ineligible cells (index into ELIGIBILITY_REASONS)
+    and a compact table of the eligible cells (row-major order) holding the per cell attributes
+    (row_starts gives each row's slice of the table).
+    The soil check is left to the caller (see apply_eligibility_cache).
+    """
+    lats, lons = bounding_box_lats_lons(lat_lon_bounds, s_resolution, s_res_scale_factor)
+    lats_2d = lats[:, np.newaxis]
+    lons_2d = lons[np.newaxis, :]
+
+    plan = {
+        "lats": lats.tolist(),
+        "lons": lons.tolist(),
+        "s_rows": ((s_lat_0 - lats) / s_resolution).astype(int).tolist(),
+        "s_cols": ((lons - s_lon_0) / s_resolution).astype(int).tolist(),
+        "c_rows": ((c_lat_0 - lats) / c_resolution).astype(int).tolist(),
+        "c_cols": ((lons - c_lon_0) / c_resolution).astype(int).tolist(),
+        "s_row_0": int((s_lat_0 - lats[0]) / s_resolution),
+        "s_col_0": int((lons[0] - s_lon_0) / s_resolution),
+        "no_of_rows": len(lats),
+        "no_of_cols": len(lons),
+        "aer": None,
+    }
+    shape = (len(lats), len(lons))
+    eligible = np.ones(shape, dtype=bool)
+    reasons = np.zeros(shape, dtype=np.uint8)
+
+    def check(passed, reason):
+        # the first failed check is the reason of a cell
+        reasons[eligible & ~passed] = ELIGIBILITY_REASONS.index(reason)
+        eligible[...] &= passed
+
+    aer = np.zeros(shape, dtype=int)
+    planting_doy = harvest_doy = np.zeros(shape, dtype=int)
+
+    # management is either given by the agro-ecological region or by planting/harvest dates
+    if eco_data:
+        aer, in_bounds = grid_values(eco_data, lats_2d, lons_2d, fill_value=0)
+        plan["aer"] = aer
+        check(in_bounds & (aer > 0) & np.isin(aer, list(valid_aers or [])), "mgmt")
+    else:
+        planting_doy, p_in_bounds = grid_values(planting_data, lats_2d, lons_2d)
+        harvest_doy, h_in_bounds = grid_values(harvest_data, lats_2d, lons_2d)
+        check(p_in_bounds & (planting_doy != planting_data["metadata"]["nodata_value"])
+              & h_in_bounds & (harvest_doy != harvest_data["metadata"]["nodata_value"]), "mgmt")
+
+    height_nn, in_bounds = grid_values(dem_data, lats_2d, lons_2d)
+    check(in_bounds, "dem")
+    if "nodata_value" in dem_data["metadata"]:
+        check(height_nn != dem_data["metadata"]["nodata_value"], "dem")
+
+    slope, _ = grid_values(slope_data, lats_2d, lons_2d)
+    slope[slope == slope_data["metadata"]["nodata_value"]] = 0
+
+    country_id = np.zeros(shape, dtype=int)
+    if country_id_data:
+        country_id, in_bounds = grid_values(country_id_data, lats_2d, lons_2d, fill_value=0)
+        check(in_bounds & (country_id != country_id_data["metadata"]["nodata_value"]) & (country_id != 0), "country")
+        if only_country_ids:
+            check(np.isin(country_id, only_country_ids), "country")
+
+    plan["eligible"] = eligible
+    plan["reasons"] = reasons
+    rows, cols = np.nonzero(eligible)
+    # index range of each row's cells in the table
+    plan["row_starts"] = np.searchsorted(rows, np.arange(len(lats) + 1)).tolist()
+    plan["cells"] = {
+        "row": rows.tolist(),
+        "col": cols.tolist(),
+        "aer": aer[rows, cols].tolist(),
+        "planting_doy": planting_doy[rows, cols].tolist(),
+        "harvest_doy": harvest_doy[rows, cols].tolist(),
+        "height_nn": height_nn[rows, cols].tolist(),
+        "slope": slope[rows, cols].tolist(),
+        "country_id": country_id[rows, cols].tolist(),
+    }
+    return plan
+
+
+def create_work_plan_cached(lat_lon_bounds, s_lat_0, s_lon_0, s_resolution, s_res_scale_factor, **kwargs):
+    """create_work_plan, but return the last plan again if the bounds, grids and filters are the same
+    (e.g. one crop under several gcms), the grids come from load_grid_cached and are compared by identity"""
+    key = (json.dumps(lat_lon_bounds, sort_keys=True), s_lat_0, s_lon_0, s_resolution, s_res_scale_factor,
+           tuple((k, id(v) if isinstance(v, dict) else json.dumps(v)) for k, v in sorted(kwargs.items())))
+    last = getattr(create_work_plan_cached, "last", None)
+    if last and last[0] == key:
+        return last[1]
+    plan = create_work_plan(lat_lon_bounds, s_lat_0, s_lon_0, s_resolution, s_res_scale_factor, **kwargs)
+    create_work_plan_cached.last = (key, plan)
+    return plan
+
+
+def file_fingerprint(path):
+    """the real path, size and modification time of a file, the grids and soil netcdfs are too big to hash
+    their content on every run"""
+    stat = os.stat(path)
+    return [os.path.realpath(path), stat.st_size, stat.st_mtime_ns]
+
+
+def eligibility_key(*inputs):
+    """hash of the inputs the eligibility of the cells depends on, the grids (from load_grid_cached), the soil
+    dataset and file paths (e.g. of a management csv) are represented by the fingerprints of their files"""
+    def fingerprint(value):
+        if isinstance(value, GlobalSoilDataSet):
+            return [file_fingerprint(path) for path in value.paths] + \
+                ([file_fingerprint(value.catalog["path"] + "/index.npy")] if value.catalog else [])
+        if isinstance(value, dict) and "grid" in value and "path" in value:
+            return file_fingerprint(value["path"])
+        if isinstance(value, str) and os.path.isfile(value):
+            return file_fingerprint(value)
+        return value
+    return hashlib.sha1(json.dumps([fingerprint(value) for value in inputs], sort_keys=True,
+                                   default=str).encode("utf8")).hexdigest()
+
+
+class EligibilityCache:
+    """the reasons (index into ELIGIBILITY_REASONS, 0 = eligible) the cells of a bounding box are sent as nodata,
+    persisted as eligibility_<key>.npy in path_to_cache_dir, so the checks (above all the soil probe) are done once
+    for the same inputs (see eligibility_key), if not hit the reasons are set while checking and saved after"""
+
+    def __init__(self, path_to_cache_dir, key, shape):
+        self.path = f"{path_to_cache_dir}/eligibility_{key}.npy"
+        self.hit = False
+        if os.path.exists(self.path):
+            reasons = np.load(self.path)
+            if reasons.shape == tuple(shape):
+                self.reasons = reasons
+                self.hit = True
+                print("loaded eligibility cache:", self.path)
+        if not self.hit:
+            self.reasons = np.zeros(shape, dtype=np.uint8)
+
+    def reason(self, r, c):
+        return ELIGIBILITY_REASONS[self.reasons[r, c]]
+
+    def set(self, r, c, reason):
+        self.reasons[r, c] = ELIGIBILITY_REASONS.index(reason)
+
+    def save(self):
+        if self.hit:
+            return
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        np.save(self.path, self.reasons)
+        self.hit = True
+        print("wrote eligibility cache:", self.path, "with", int((self.reasons == 0).sum()), "of",
+              self.reasons.size, "cells eligible")
+
+
+def restrict_work_plan(plan, eligible):
+    """the plan with only the cells eligible in both the plan and the given mask"""
+    eligible = plan["eligible"] & eligible
+    keep = eligible[plan["cells"]["row"], plan["cells"]["col"]]
+    cells = {key: np.asarray(values)[keep].tolist() for key, values in plan["cells"].items()}
+    row_starts = np.searchsorted(cells["row"], np.arange(plan["no_of_rows"] + 1)).tolist()
+    return {**plan, "eligible": eligible, "row_starts": row_starts, "cells": cells}
+
+
+def apply_eligibility_cache(plan, global_soil_dataset, path_to_cache_dir, key):
+    """the plan without the cells lacking a valid soil profile, they are taken from the cache or
+    probed once (for all eligible cells of the plan) and cached"""
+    cache = EligibilityCache(path_to_cache_dir, key, plan["eligible"].shape)
+    if not cache.hit:
+        cache.reasons[...] = plan["reasons"]
+        for r, c in zip(plan["cells"]["row"], plan["cells"]["col"]):
+            if not global_soil_dataset.has_soil_profile(plan["s_rows"][r], plan["s_cols"][c]):
+                cache.set(r, c, "soil")
+        cache.save()
+    return {**restrict_work_plan(plan, cache.reasons == 0), "reasons": cache.reasons}
+
+
+def row_groups(plan, shard=0, no_of_shards=1, by_climate_cell=False):
+    """the rows of the work plan to send together, either single rows or all rows of a climate row,
+    the groups are dealt to the shards in turn"""
+    if by_climate_cell:
+        groups = [[r for r, _ in rows] for _, rows in groupby(enumerate(plan["c_rows"]), key=lambda rc: rc[1])]
+    else:
+        groups = [[r] for r in range(plan["no_of_rows"])]
+    return groups[shard::no_of_shards]
+
+
+def cell_order(plan, rows, by_climate_cell=False):
+    """(row, index into the cells table) of the eligible cells of rows in the order to send them,
+    row by row or climate cell by climate cell, so the workers read the same climate file in a row"""
+    order = [(r, i) for r in rows for i in range(plan["row_starts"][r], plan["row_starts"][r + 1])]
+    if by_climate_cell:
+        c_cols = plan["c_cols"]
+        cols = plan["cells"]["col"]
+        order.sort(key=lambda ri: c_cols[cols[ri[1]]])
+    return order
+
+
+# columns of the global 0.5 degree climate grid, the c_cols of the work plan (c_lon_0 -179.75)
+NO_OF_CLIMATE_COLS = 720
+
+
+def climate_cell_endpoint(c_row, c_col, no_of_endpoints):
+    """index of the endpoint (socket) the envs of a climate cell are sent to, it only depends on the climate cell,
+    so a climate cell keeps its proxy across the runs and the shards"""
+    return (c_row * NO_OF_CLIMATE_COLS + c_col) % no_of_endpoints
+
+
+def env_id(count, shard=0, no_of_shards=1):
+    """env_id of the customId of the count-th (from 0) env a shard sends for a setup, the ids are unique per setup
+    (not per run) across the shards, a resumed producer continues the count after the envs of the setup in its
+    journal, so the ids of a resumed run don't repeat the ones sent before"""
+    return count * no_of_shards + shard + 1
+
+
+def env_hash(env, climate_id=None, custom_id_keys=None):
+    """hash of the parts of an env set cell by cell, the customId excluded,
+    everything else is set once per setup, climate_id stands for inlined climate data,
+    custom_id_keys are the parts of the customId the consumer keys the results by (e.g. the aer)"""
+    return hashlib.blake2b(json.dumps([env["cropRotation"], env["params"], env["pathToClimateCSV"],
+                                       climate_id, custom_id_keys]).encode(), digest_size=16).digest()
+
+
+# climate elements in the order of MONICA's Climate::ACD enum, the index is the acd id
+CLIMATE_ELEMENTS = ["day", "month", "year", "tmin", "tavg", "tmax", "precip", "globrad", "wind", "sunhours",
+                    "cloudamount", "relhumid", "airpress", "vaporpress", "co2", "o3", "et0", "dewpointTemp",
+                    "specificHumidity", "snowfallFlux", "surfaceDownwellingLongwaveRadiation", "potET"]
+
+
+def read_climate_csv(lines, csv_options):
+    """read climate csv lines into a list of iso dates and a dict of element -> values"""
+    sep = csv_options.get("csv-separator", ",")
+    no_of_header_lines = csv_options.get("no-of-climate-file-header-lines", 2)
+    header_to_acd_names = csv_options.get("header-to-acd-names", {})
+
+    reader = csv.reader(lines, delimiter=sep)
+    header = next(reader)
+    for _ in range(no_of_header_lines - 1):
+        next(reader)
+
+    # column index -> (element, conversion)
+    cols = {}
+    date_col = None
+    for i, name in enumerate(header):
+        name = name.strip()
+        acd_name = header_to_acd_names.get(name, name)
+        op, factor = None, None
+        if isinstance(acd_name, list):
+            acd_name, op, factor = acd_name
+        if acd_name in ["iso-date", "de-date"]:
+            date_col = (i, acd_name)
+        elif acd_name in CLIMATE_ELEMENTS[3:]:
+            cols[i] = (acd_name, op, factor)
+
+    dates = []
+    data = {elem: [] for elem, _, _ in cols.values()}
+    for row in reader:
+        if not row:
+            continue
+        d = row[date_col[0]].strip()
+        dates.append(d if date_col[1] == "iso-date" else datetime.strptime(d, "%d.%m.%Y").date().isoformat())
+        for i, (elem, op, factor) in cols.items():
+            v = float(row[i])
+            if op == "*":
+                v *= factor
+            elif op == "+":
+                v += factor
+            data[elem].append(v)
+    return dates, data
+
+
+def read_climate_csv_files(paths_to_csvs, csv_options):
+    """read and concatenate (gzipped) climate csv files, e.g. historical and scenario"""
+    if isinstance(paths_to_csvs, str):
+        paths_to_csvs = [paths_to_csvs]
+    all_dates = []
+    all_data = {}
+    for path_to_csv in paths_to_csvs:
+        with (gzip.open(path_to_csv, "rt") if path_to_csv.endswith(".gz") else open(path_to_csv)) as _:
+            dates, data = read_climate_csv(_, csv_options)
+        # cut off the overlap with the next file
+        end = bisect_left(all_dates, dates[0]) if dates else len(all_dates)
+        all_dates = all_dates[:end] + dates
+        for elem, vals in data.items():
+            all_data[elem] = all_data.get(elem, [])[:end] + vals
+    return all_dates, all_data
+
+
+def climate_data_to_json(dates, data, start_date=None, end_date=None):
+    """json of a MONICA Climate::DataAccessor of the climate data from start_date to end_date"""
+    start = bisect_left(dates, start_date) if start_date else 0
+    end = bisect_right(dates, end_date) if end_date else len(dates)
+    acd2data_index = [-1] * len(CLIMATE_ELEMENTS)
+    d = []
+    for elem, vals in data.items():
+        acd2data_index[CLIMATE_ELEMENTS.index(elem)] = len(d)
+        d.append(vals[start:end])
+    return {
+        "type": "DataAccessor",
+        "data": d,
+        "startDate": dates[start] if end > start else "",
+        "endDate": dates[end - 1] if end > start else "",
+        "fromStep": 0,
+        "numberOfSteps": end - start,
+        "acd2dataIndex": acd2data_index
+    }
+
+
+# the climate.csv-options read_climate_csv and climate_data_to_json depend on
+CLIMATE_CSV_OPTIONS = ("csv-separator", "no-of-climate-file-header-lines", "header-to-acd-names", "start-date",
+                       "end-date")
+
+
+class ClimateDataCache:
+    """the parsed climate csvs of the last used maxsize climate cells, so a climate cell is read only once,
+    a climate cell read with other csv options (e.g. by another setup) is an entry of its own"""
+
+    def __init__(self, maxsize=64):
+        self.maxsize = maxsize
+        self.key_to_data = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def climate_data(self, key, paths_to_csvs, csv_options):
+        """climate data (json of a MONICA Climate::DataAccessor) of the climate cell key,
+        from the start-date to the end-date of the csv options"""
+        key = (key, json.dumps([csv_options.get(option) for option in CLIMATE_CSV_OPTIONS]))
+        if key in self.key_to_data:
+            self.key_to_data.move_to_end(key)
+            self.hits += 1
+        else:
+            self.key_to_data[key] = read_climate_csv_files(paths_to_csvs, csv_options)
+            self.misses += 1
+            if len(self.key_to_data) > self.maxsize:
+                self.key_to_data.popitem(last=False)
+        dates, data = self.key_to_data[key]
+        return climate_data_to_json(dates, data, csv_options.get("start-date"), csv_options.get("end-date"))
+
+
+def dumps_bytes(obj):
+    """JSON encode obj to utf-8 bytes, with orjson if it is installed"""
+    if orjson:
+        return orjson.dumps(obj, option=orjson.OPT_SERIALIZE_NUMPY)
+    return json.dumps(obj, separators=(",", ":")).encode("utf-8")
+
+
+def _get_path(obj, path):
+    for key in path:
+        obj = obj[key]
+    return obj
+
+
+def _set_path(obj, path, value):
+    _get_path(obj, path[:-1])[path[-1]] = value
+
+
+def env_cell_paths(env, crop_varies=False):
+    """the key paths of the env values the producers set cell by cell,
+    the crop of the sowing workstep only varies with optimized params or per aer field condition modifiers"""
+    paths = [("customId",), ("pathToClimateCSV",), ("climateData",)]
+    for key in ("SoilProfileParameters", "heightNN", "slope", "Latitude"):
+        paths.append(("params", "siteParameters", key))
+    for k, ws in enumerate(env["cropRotation"][0]["worksteps"]):
+        for key in ("date", "latest-date", "amount", "PlantDensity"):
+            paths.append(("cropRotation", 0, "worksteps", k, key))
+        if crop_varies and "crop" in ws:
+            paths.append(("cropRotation", 0, "worksteps", k, "crop"))
+    return paths
+
+
+class EnvEncoder:
+    """encodes the envs of a setup, the env is serialized once with markers at the given key paths (paths
+    missing in the env are ignored), afterwards only the values at the paths are encoded and spliced in
+    between the invariant fragments, so the keys of the env must not change anymore"""
+
+    def __init__(self, env, paths):
+        paths = [path for path in paths if self._has_path(env, path)]
+        values = [_get_path(env, path) for path in paths]
+        markers = [f"\0env-encoder-{i}\0" for i in range(len(paths))]
+        for path, marker in zip(paths, markers):
+            _set_path(env, path, marker)
+        try:
+            encoded = dumps_bytes(env)
+        finally:
+            for path, value in zip(paths, values):
+                _set_path(env, path, value)
+
+        encoded_markers = [dumps_bytes(marker) for marker in markers]
+        order = sorted(range(len(paths)), key=lambda i: encoded.index(encoded_markers[i]))
+        self.paths = [paths[i] for i in order]
+        self.fragments = []
+        for i in order:
+            fragment, encoded = encoded.split(encoded_markers[i], 1)
+            self.fragments.append(fragment)
+        self.fragments.append(encoded)
+
+    @staticmethod
+    def _has_path(env, path):
+        try:
+            _get_path(env, path)
+            return True
+        except (KeyError, IndexError, TypeError):
+            return False
+
+    def encode(self, env):
+        parts = [self.fragments[0]]
+        for path, fragment in zip(self.paths, self.fragments[1:]):
+            parts.append(dumps_bytes(_get_path(env, path)))
+            parts.append(fragment)
+        return b"".join(parts)
+
+
+class SetupRegistry:
+    """completes the compact customIds (setup_id, s_row, s_col, env_id and flags) of the messages with the
+    metadata the producer registered once per setup (customId with setup_meta), cell messages arriving before
+    their setup was registered are held back, everything else (e.g. envs counts) passes through as it is"""
+
+    def __init__(self):
+        self.setup_id_to_meta = {}
+        self.setup_id_to_pending = defaultdict(list)
+
+    def resolve(self, msg):
+        """the messages ready to be processed"""
+        custom_id = msg.get("customId", {})
+        setup_id = custom_id.get("setup_id")
+        if "setup_meta" in custom_id:
+            self.setup_id_to_meta[setup_id] = custom_id["setup_meta"]
+            return [self._complete(msg_) for msg_ in self.setup_id_to_pending.pop(setup_id, [])]
+        if setup_id in self.setup_id_to_meta:
+            return [self._complete(msg)]
+        if "s_row_0" not in custom_id and ("s_row" in custom_id or "nodata_ranges" in msg or "fanout" in msg):
+            self.setup_id_to_pending[setup_id].append(msg)
+            return []
+        return [msg]
+
+    def _complete(self, msg):
+        msg["customId"] = {**self.setup_id_to_meta[msg["customId"]["setup_id"]], **msg["customId"]}
+        return msg
+
+
+class FeedbackReporter:
+    """consumer side of the credit based flow control, publishes the results received from MONICA,
+    the cells committed to the grids and the cells waiting for their row to be complete (backlog)
+    every interval_ms on the feedback socket"""
+
+    def __init__(self, feedback_socket, interval_ms=1000):
+        self.socket = feedback_socket
+        self.interval_ms = interval_ms
+        self.received = 0
+        self.committed = 0
+        self.last_report_time = 0
+        self.last_message_time = time.perf_counter()
+
+    def message_received(self, from_monica=True):
+        self.last_message_time = time.perf_counter()
+        if from_monica:
+            self.received += 1
+
+    def idle_ms(self):
+        return (time.perf_counter() - self.last_message_time) * 1000
+
+    def report(self, backlog):
+        """publish the counts if the interval passed, backlog is a function counting the buffered cells"""
+        now = time.perf_counter()
+        if (now - self.last_report_time) * 1000 >= self.interval_ms:
+            report = {"received": self.received, "committed": self.committed, "backlog": backlog()}
+            self.socket.send_json(report)
+            self.last_report_time = now
+            print("flow control report: ", report)
+
+
+class CreditWindow:
+    """producer side of the credit based flow control, caps the envs in flight (sent to MONICA, but not received
+    by the consumer yet) to window, each of several producer shards counts with its share of the received results"""
+
+    def __init__(self, feedback_socket, window, no_of_shards=1, stall_timeout_ms=60000):
+        self.socket = feedback_socket
+        self.window = window
+        self.no_of_shards = no_of_shards
+        self.stall_timeout_ms = stall_timeout_ms
+        self.sent = 0
+        self.received_0 = None  # results the consumer received before this producer started
+        self.report = {"received": 0, "committed": 0, "backlog": 0}
+        self.max_in_flight = 0
+        self.waited = 0.0
+
+    def _read_reports(self, timeout_ms=0):
+        """read the pending reports, waiting timeout_ms for the first one, returns if there was a report"""
+        got_report = False
+        while self.socket.poll(timeout_ms):
+            self.report = self.socket.recv_json()
+            if self.received_0 is None:
+                # a consumer reporting late started after this producer, so all results it counted are ours
+                self.received_0 = self.report["received"] if self.sent == 0 else 0
+            got_report = True
+            timeout_ms = 0
+        return got_report
+
+    def in_flight(self):
+        return self.sent - (self.report["received"] - (self.received_0 or 0)) / self.no_of_shards
+
+    def acquire(self):
+        """wait until the window allows to send one more env"""
+        if self.sent == 0 and self.received_0 is None:
+            self._read_reports(5000)
+        self._read_reports()
+        if self.in_flight() >= self.window:
+            start_time = time.perf_counter()
+            while self.in_flight() >= self.window:
+                if not self._read_reports(self.stall_timeout_ms):
+                    print("no feedback from the consumer for ", self.stall_timeout_ms, " ms, sending on")
+                    break
+            self.waited += time.perf_counter() - start_time
+        self.sent += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight())
+
+    def metrics(self):
+        return {"window": self.window, "in_flight": self.in_flight(), "max_in_flight": self.max_in_flight,
+                "backlog": self.report["backlog"], "committed": self.report["committed"],
+                "waited": round(self.waited, 3)}
+
+
+class ProducerStats:
+    """stage timers and counters of a producer run, lap(stage) adds the time since the last lap (or start())
+    to the stage, tick() prints a summary line every summary_interval seconds and sample() tells if the current
+    env is logged (log_sample_rate 1 logs every env, 0 none)"""
+
+    def __init__(self, log_sample_rate=0.0, summary_interval=30.0):
+        self.log_sample_rate = log_sample_rate
+        self.summary_interval = summary_interval
+        self.stage_to_secs = defaultdict(float)
+        self.counters = defaultdict(int)
+        self.skipped = defaultdict(int)
+        self.start_time = self.last_lap_time = self.last_summary_time = time.perf_counter()
+        self.samples_due = 0.0
+
+    def start(self):
+        self.last_lap_time = time.perf_counter()
+
+    def lap(self, stage):
+        now = time.perf_counter()
+        self.stage_to_secs[stage] += now - self.last_lap_time
+        self.last_lap_time = now
+
+    def count(self, counter, n=1):
+        self.counters[counter] += n
+
+    def skip(self, reason, n=1):
+        self.skipped[reason] += n
+
+    def sample(self):
+        self.samples_due += self.log_sample_rate
+        if self.samples_due >= 1:
+            self.samples_due -= 1
+            return True
+        return False
+
+    def report(self):
+        secs = time.perf_counter() - self.start_time
+        return {
+            "secs": round(secs, 3),
+            "envs_per_sec": round(self.counters["sent"] / secs, 1) if secs > 0 else 0,
+            "counters": dict(self.counters),
+            "skipped": dict(self.skipped),
+            "stage_secs": {stage: round(secs, 3) for stage, secs in self.stage_to_secs.items()},
+        }
+
+    def tick(self):
+        now = time.perf_counter()
+        if now - self.last_summary_time >= self.summary_interval:
+            self.last_summary_time = now
+            print("producer stats: ", json.dumps(self.report()))
+
+    def write_report(self, path_to_report):
+        report = self.report()
+        print("producer stats: ", json.dumps(report))
+        if path_to_report:
+            with open(path_to_report, "w") as _:
+                json.dump(report, _, indent=2)
+
+
+class DryRunSocket:
+    """stands in for a PUSH socket of a producer in a dry run, counts the messages instead of sending them"""
+
+    def __init__(self, dry_run):
+        self.dry_run = dry_run
+
+    def connect(self, endpoint):
+        pass
+
+    def close(self):
+        pass
+
+    def send(self, data, copy=True):
+        # only the encoded envs are sent as bytes
+        self.dry_run.record(len(data))
+
+    def send_json(self, obj):
+        self.dry_run.record(len(json.dumps(obj).encode("utf8")), obj)
+
+
+class DryRun:
+    """counts what a producer would send per setup, the envs, the nodata cells (sent or run-length encoded), the
+    messages and bytes and the distinct climate files, switch_to(setup_id) tells which setup is being sent (the
+    setups of sweep_setups take turns) and times it, the wall time of a real run is estimated from the measured
+    time plus the bytes on the wire at bandwidth_mb_per_sec"""
+
+    def __init__(self, bandwidth_mb_per_sec=100.0):
+        self.bandwidth = bandwidth_mb_per_sec * 1e6
+        self.setup_id = None
+        self.switch_time = time.perf_counter()
+        self.setups = defaultdict(lambda: {"envs": 0, "nodata": 0, "fanout": 0, "messages": 0, "bytes": 0,
+                                           "climate_files": set(), "secs": 0.0})
+
+    def socket(self):
+        return DryRunSocket(self)
+
+    def switch_to(self, setup_id):
+        now = time.perf_counter()
+        if self.setup_id is not None:
+            self.setups[self.setup_id]["secs"] += now - self.switch_time
+        self.setup_id = setup_id
+        self.switch_time = now
+
+    def record(self, no_of_bytes, msg=None):
+        setup = self.setups[self.setup_id]
+        setup["messages"] += 1
+        setup["bytes"] += no_of_bytes
+        custom_id = msg.get("customId", {}) if msg else {}
+        if msg is None or not custom_id.get("nodata", True):
+            setup["envs"] += 1
+        elif "nodata_ranges" in msg:
+            setup["nodata"] += sum(n for _, _, n in msg["nodata_ranges"])
+        elif "fanout" in msg:
+            setup["fanout"] += len(msg["fanout"])
+        elif "s_row" in custom_id:
+            setup["nodata"] += 1
+
+    def touch_climate(self, paths):
+        self.setups[self.setup_id]["climate_files"].update(paths)
+
+    def report(self, encode_secs=0.0):
+        """the counts and estimated secs per setup and in total, encode_secs is the time spent encoding the envs"""
+        setups = {}
+        total = {"envs": 0, "nodata": 0, "fanout": 0, "messages": 0, "bytes": 0, "secs": 0.0}
+        climate_files = set()
+        for setup_id, setup in self.setups.items():
+            setups[setup_id] = {key: value for key, value in setup.items() if key != "climate_files"}
+            setups[setup_id]["climate_files"] = len(setup["climate_files"])
+            setups[setup_id]["secs"] = round(setup["secs"], 3)
+            setups[setup_id]["est_secs"] = round(setup["secs"] + setup["bytes"] / self.bandwidth, 1)
+            for key in total:
+                total[key] += setup[key]
+            climate_files |= setup["climate_files"]
+        total["climate_files"] = len(climate_files)
+        total["secs"] = round(total["secs"], 3)
+        total["est_secs"] = round(total["secs"] + total["bytes"] / self.bandwidth, 1)
+        total["bytes_per_env"] = round(total["bytes"] / total["envs"]) if total["envs"] else 0
+        total["encode_secs_per_env"] = round(encode_secs / total["envs"], 6) if total["envs"] else 0
+        return {"setups": setups, "total": total}
+
+    def print_report(self, encode_secs=0.0):
+        report = self.report(encode_secs)
+        for setup_id, setup in report["setups"].items():
+            print("dry run setup ", setup_id, ": ", setup)
+        print("dry run total: ", report["total"])
+        return report
+
+
+def decode_message(frame, decode):
+    """the message of a raw frame with the result of decode(msg) under "decoded" instead of the result sections,
+    run in the processes of a DecodePool"""
+    msg = orjson.loads(frame) if orjson else json.loads(frame)
+    if msg.get("data") and not msg.get("errors") and not msg.get("customId", {}).get("nodata"):
+        msg["decoded"] = decode(msg)
+        del msg["data"]
+    return msg
+
+
+class DecodePool:
+    """pipelined receiving for the consumers, a thread pulls the raw frames from the sockets of the poller and
+    a pool of workers processes decodes them (see decode_message, decode has to be a module level function),
+    get returns the messages in the order they were received, so a single writer owns the state and the files,
+    at most max_depth messages are waiting, then the receiver blocks and the frames queue up in zmq"""
+
+    def __init__(self, poller, monica_socket, decode, workers, max_depth=1000):
+        self.decode = decode
+        self.executor = concurrent.futures.ProcessPoolExecutor(workers)
+        # start the worker processes before the receiver thread
+        self.executor.submit(int).result()
+        self.queue = queue.Queue(max_depth)
+        self.depth_max = 0
+        self.stop = threading.Event()
+        self.thread = threading.Thread(target=self._receive, args=(poller, monica_socket), daemon=True)
+        self.thread.start()
+
+    def _receive(self, poller, monica_socket):
+        while not self.stop.is_set():
+            for sock in dict(poller.poll(100)):
+                future = self.executor.submit(decode_message, sock.recv(), self.decode)
+                while not self.stop.is_set():
+                    try:
+                        self.queue.put((future, sock is monica_socket), timeout=0.1)
+                        break
+                    except queue.Full:
+                        continue
+                self.depth_max = max(self.depth_max, self.queue.qsize())
+
+    def depth(self):
+        """the number of messages received, but not taken by the writer yet"""
+        return self.queue.qsize()
+
+    def get(self, timeout_ms):
+        """the next message and whether it came from MONICA, (None, False) if none came within timeout_ms"""
+        try:
+            future, from_monica = self.queue.get(timeout=timeout_ms / 1000)
+        except queue.Empty:
+            return None, False
+        return future.result(), from_monica
+
+    def close(self):
+        self.stop.set()
+        self.thread.join()
+        self.executor.shutdown(cancel_futures=True)
+        print("decode pool: max queue depth", self.depth_max)
+
+class LatencyTracker:
+    """consumer side latency tracing, the producers stamp the send time (sent, seconds since the epoch) and their
+    shard into the customId of the envs, received(custom_id) records the result of a cell and committed(setup_id, row)
+    the row written to the grids, the latencies go to histograms by stage (transit: sent -> received, i.e. proxy
+    queue and MONICA, commit: received -> committed, i.e. waiting for the row, total: sent -> committed),
+    tick() writes the metrics to path_to_metrics (.json or csv) and updates the prometheus text every interval secs"""
+
+    BUCKETS = (0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300, 600, 1800, 3600)  # upper bounds in seconds
+    STAGES = ("transit", "commit", "total")
+
+    def __init__(self, path_to_metrics="", interval=30.0):
+        self.path_to_metrics = path_to_metrics
+        self.interval = interval
+        self.last_write_time = time.perf_counter()
+        self.stage_to_counts = {stage: [0] * (len(self.BUCKETS) + 1) for stage in self.STAGES}
+        self.stage_to_sum = defaultdict(float)
+        self.shard_to_results = defaultdict(int)
+        self.row_to_times = defaultdict(list)  # (setup_id, row) -> (sent, received) of the cells not committed yet
+        self.setups = {}
+        self.gauges = {}  # name -> current value, e.g. the depth of the decode queue
+        self.exposition = ""
+
+    def _observe(self, stage, secs):
+        counts = self.stage_to_counts[stage]
+        for i, bound in enumerate(self.BUCKETS):
+            if secs <= bound:
+                counts[i] += 1
+                break
+        else:
+            counts[-1] += 1
+        self.stage_to_sum[stage] += secs
+
+    def _setup(self, setup_id, now):
+        if setup_id not in self.setups:
+            self.setups[setup_id] = {"results": 0, "rows": 0, "first_sent": None, "first_received": now,
+                                     "last_received": now, "first_row": None, "last_row": None}
+        return self.setups[setup_id]
+
+    def received(self, custom_id):
+        now = time.time()
+        setup = self._setup(custom_id["setup_id"], now)
+        setup["results"] += 1
+        setup["last_received"] = now
+        sent = custom_id.get("sent")
+        if sent is not None:
+            self._observe("transit", now - sent)
+            self.shard_to_results[custom_id.get("shard", 0)] += 1
+            if setup["first_sent"] is None or sent < setup["first_sent"]:
+                setup["first_sent"] = sent
+        self.row_to_times[(custom_id["setup_id"], custom_id["s_row"])].append((sent, now))
+
+    def committed(self, setup_id, row):
+        now = time.time()
+        for sent, received in self.row_to_times.pop((setup_id, row), []):
+            self._observe("commit", now - received)
+            if sent is not None:
+                self._observe("total", now - sent)
+        setup = self._setup(setup_id, now)
+        setup["rows"] += 1
+        if setup["first_row"] is None:
+            setup["first_row"] = now
+        setup["last_row"] = now
+
+    def gauge(self, name, value):
+        self.gauges[name] = value
+
+    def committed_all(self):
+        """commit the rows of all cells received, for consumers aggregating the results of a whole run"""
+        for setup_id, row in list(self.row_to_times):
+            self.committed(setup_id, row)
+
+    def report(self):
+        setups = {}
+        for setup_id, setup in self.setups.items():
+            t_0 = setup["first_sent"] or setup["first_received"]
+            secs = setup["last_received"] - setup["first_received"]
+            setups[setup_id] = {
+                "results": setup["results"],
+                "rows": setup["rows"],
+                "results_per_sec": round(setup["results"] / secs, 1) if secs > 0 else 0,
+                "time_to_first_row": round(setup["first_row"] - t_0, 3) if setup["first_row"] else None,
+                "time_to_last_row": round(setup["last_row"] - t_0, 3) if setup["last_row"] else None,
+            }
+        return {
+            "buckets": list(self.BUCKETS),
+            "latency": {stage: {"counts": counts, "sum": round(self.stage_to_sum[stage], 3)}
+                        for stage, counts in self.stage_to_counts.items()},
+            "shards": dict(self.shard_to_results),
+            "setups": setups,
+            "gauges": dict(self.gauges),
+        }
+
+    def samples(self, report=None):
+        """the metrics as (name, labels, value), the samples of the prometheus text format"""
+        report = report or self.report()
+        samples = []
+        for stage, latency in report["latency"].items():
+            cumulative = 0
+            for bound, count in zip(list(self.BUCKETS) + ["+Inf"], latency["counts"]):
+                cumulative += count
+                samples.append(("consumer_latency_seconds_bucket", {"stage": stage, "le": bound}, cumulative))
+            samples.append(("consumer_latency_seconds_sum", {"stage": stage}, latency["sum"]))
+            samples.append(("consumer_latency_seconds_count", {"stage": stage}, cumulative))
+        for shard, results in report["shards"].items():
+            samples.append(("consumer_shard_results_total", {"shard": shard}, results))
+        for setup_id, setup in report["setups"].items():
+            for key, value in setup.items():
+                if value is not None:
+                    samples.append((f"consumer_setup_{key}", {"setup_id": setup_id}, value))
+        for name, value in report.get("gauges", {}).items():
+            samples.append((f"consumer_{name}", {}, value))
+        return samples
+
+    def tick(self, force=False):
+        now = time.perf_counter()
+        if not force and now - self.last_write_time < self.interval:
+            return
+        self.last_write_time = now
+        report = self.report()
+        samples = self.samples(report)
+        # swapped in as a whole, the metrics server thread only ever reads it
+        self.exposition = "".join(
+            name + ("{" + ",".join(f'{k}="{v}"' for k, v in labels.items()) + "}" if labels else "") + " "
+            + str(value) + "\n"
+            for name, labels, value in samples)
+        if self.path_to_metrics.endswith(".json"):
+            with open(self.path_to_metrics, "w") as _:
+                json.dump(report, _, indent=2)
+        elif self.path_to_metrics:
+            with open(self.path_to_metrics, "w", newline="") as _:
+                writer = csv.writer(_)
+                writer.writerow(["metric", "labels", "value"])
+                for name, labels, value in samples:
+                    writer.writerow([name, ";".join(f"{k}={v}" for k, v in labels.items()), value])
+
+    def serve(self, port):
+        """serve the prometheus text of the last tick on http://localhost:port/metrics"""
+        tracker = self
+
+        class MetricsHandler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = tracker.exposition.encode("utf8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        server = http.server.ThreadingHTTPServer(("localhost", int(port)), MetricsHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server
+
+
+class MonicaStandIn:
+    """offline stand-in for monica-zmq-proxy and its monica-zmq-servers (see start_monicas.sh), receives the envs on
+    in_socket and sends a result per env on out_socket latency_ms later, with up to workers envs worked on at once,
+    the result echoes the customId and has synthetic data sections shaped like the events of the env (one row per
+    year, daily sections one row per day), the envs flagged nodata are forwarded right away, inline climate data
+    (climateData of the env) is checked and its years are the years of the results"""
+
+    # OP_NONE and ORGAN_UNDEFINED_ORGAN_ of monica_io3, shared is imported before the path to it is set
+    OP_NONE = 7
+    ORGAN_UNDEFINED_ORGAN_ = 6
+
+    def __init__(self, in_socket, out_socket, latency_ms=0.0, workers=1, start_year=1980, years=30):
+        self.in_socket = in_socket
+        self.out_socket = out_socket
+        self.latency = latency_ms / 1000
+        self.worker_free_times = [0.0] * workers
+        self.start_year = start_year
+        self.years = years
+        self.due = []  # heap of (due time, sequence no, result)
+        self.received = 0
+        self.sent = 0
+        self.bytes_received = 0
+        self.first_env_time = None
+        self.last_result_time = None
+        self.inline_climate = 0
+
+    def climate_years(self, climate_data):
+        """the years of inline climate data, raises ValueError if it isn't a consistent DataAccessor"""
+        if climate_data.get("type") != "DataAccessor" or climate_data["numberOfSteps"] == 0:
+            raise ValueError("no climate data")
+        if any(len(vals) != climate_data["numberOfSteps"] for vals in climate_data["data"]):
+            raise ValueError("climate data of " + str(climate_data["numberOfSteps"]) + " steps expected")
+        start = date.fromisoformat(climate_data["startDate"])
+        end = date.fromisoformat(climate_data["endDate"])
+        if (end - start).days + 1 != climate_data["numberOfSteps"]:
+            raise ValueError("climate data from " + str(start) + " to " + str(end) + " isn't daily")
+        return range(start.year, end.year + 1)
+
+    def create_data(self, events, custom_id, years=None):
+        """synthetic results for the sections of the events, the values only vary by cell and year"""
+        seed = custom_id.get("s_row", 0) * 31 + custom_id.get("s_col", 0) * 17
+        data = []
+        for section, outputs in zip(events[::2], events[1::2]):
+            output_ids = []
+            for i, output in enumerate(outputs):
+                name, _, display_name = (output[0] if isinstance(output, list) else output).partition("|")
+                output_ids.append({
+                    "id": i, "name": name, "displayName": display_name, "jsonInput": json.dumps(output), "unit": "",
+                    "fromLayer": -1, "toLayer": -1, "layerAggOp": self.OP_NONE, "timeAggOp": self.OP_NONE,
+                    "organ": self.ORGAN_UNDEFINED_ORGAN_,
+                })
+            names = [output_name(output) for output in outputs]
+            years = years or range(self.start_year, self.start_year + self.years)
+            if section == "daily":
+                days = [date(year, 1, 1) + timedelta(days=d) for year in years for d in range(365)]
+            else:
+                days = [date(year, 9, 1) for year in years]
+            results = []
+            for k, day in enumerate(days):
+                vals = {}
+                for name in names:
+                    if name == "CM-count":
+                        vals[name] = k + 1
+                    elif name == "Year":
+                        vals[name] = day.year
+                    elif name == "Date":
+                        vals[name] = day.isoformat()
+                    elif name == "Crop":
+                        vals[name] = "maize"
+                    elif name.endswith("DOY"):
+                        vals[name] = day.timetuple().tm_yday
+                    else:
+                        vals[name] = round(1 + (seed + day.year + k) % 100 / 10, 2)
+                results.append(vals)
+            data.append({"origSpec": json.dumps(section), "outputIds": output_ids, "results": results})
+        return data
+
+    def receive(self, now):
+        msg = self.in_socket.recv()
+        if self.first_env_time is None:
+            self.first_env_time = now
+        self.received += 1
+        self.bytes_received += len(msg)
+        env = json.loads(msg)
+        custom_id = env.get("customId", {})
+        if custom_id.get("nodata"):
+            due_time = now
+            result = {"customId": custom_id, "errors": []}
+        else:
+            # the next free worker takes the env
+            due_time = max(now, heapq.heappop(self.worker_free_times)) + self.latency
+            heapq.heappush(self.worker_free_times, due_time)
+            years = None
+            if env.get("climateData"):
+                self.inline_climate += 1
+                try:
+                    years = self.climate_years(env["climateData"])
+                except (KeyError, ValueError) as e:
+                    result = {"customId": custom_id, "errors": ["climateData: " + str(e)]}
+                    heapq.heappush(self.due, (due_time, self.received, result))
+                    return
+            result = {"customId": custom_id, "errors": [],
+                      "data": self.create_data(env.get("events", []), custom_id, years)}
+        heapq.heappush(self.due, (due_time, self.received, result))
+
+    def run(self, stop=None):
+        """relay the envs until the stop event is set"""
+        while not (stop and stop.is_set()):
+            now = time.perf_counter()
+            timeout_ms = min(100, max(0, (self.due[0][0] - now) * 1000)) if self.due else 100
+            if self.in_socket.poll(timeout_ms):
+                while self.in_socket.poll(0):
+                    self.receive(time.perf_counter())
+            now = time.perf_counter()
+            while self.due and self.due[0][0] <= now:
+                _, _, result = heapq.heappop(self.due)
+                self.out_socket.send_json(result)
+                self.sent += 1
+                self.last_result_time = now
+
+    def report(self):
+        secs = (self.last_result_time - self.first_env_time) if self.last_result_time else 0
+        return {
+            "envs": self.received,
+            "results": self.sent,
+            "in_flight": len(self.due),
+            "inline_climate": self.inline_climate,
+            "secs": round(secs, 3),
+            "envs_per_sec": round(self.sent / secs, 1) if secs > 0 else 0,
+            "bytes_per_env": round(self.bytes_received / self.received) if self.received else 0,
+        }
+
+
+def read_journal(path_to_journal):
+    """read the entries of a run journal, one json object per line"""
+    entries = []
+    if os.path.exists(path_to_journal):
+        with open(path_to_journal) as _:
+            for line in _:
+                try:
+                    entries.append(json.loads(line))
+                except json.JSONDecodeError:
+                    # the last line might have been cut off by a crash
+                    break
+    return entries
+
+
+class RunJournal:
+    """append only journal of a run, the entries of the previous run are kept if resuming"""
+
+    def __init__(self, path_to_journal, resume=False):
+        self.path = path_to_journal
+        self.entries = read_journal(path_to_journal) if resume else []
+        if resume and os.path.exists(path_to_journal):
+            # drop a line cut off by a crash, so the new entries start on a line of their own
+            with open(path_to_journal, "rb+") as _:
+                content = _.read()
+                _.truncate(content.rfind(b"\n") + 1)
+        dir_name = os.path.dirname(path_to_journal)
+        if dir_name and not os.path.exists(dir_name):
+            os.makedirs(dir_name)
+        self.file = open(path_to_journal, "a" if resume else "w")
+
+    def append(self, entry):
+        self.file.write(json.dumps(entry) + "\n")
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+def committed_rows(path_to_journal):
+    """set of (setup_id, row) written to the output grids according to a consumer journal"""
+    return {(entry["setup_id"], entry["row"]) for entry in read_journal(path_to_journal)}
+
+def restore_output_files(path_to_output_dir, path_to_file_to_size):
+    """cut the output grids back to the sizes they had at the last committed row
+    and remove the grids created after it"""
+    if not os.path.isdir(path_to_output_dir):
+        return
+    for file_name in os.listdir(path_to_output_dir):
+        path_to_file = path_to_output_dir + file_name
+        if not file_name.endswith(".asc"):
+            continue
+        if path_to_file in path_to_file_to_size:
+            with open(path_to_file, "r+") as _:
+                _.truncate(path_to_file_to_size[path_to_file])
+        else:
+            os.remove(path_to_file)
+
+
+class CellResult:
+    """the result of a cell in columns, per cm_count (or date of a daily section) the year, crop and the values
+    of the output keys, values is a (keys, cm_counts) array with nan for the keys missing, see decode"""
+
+    __slots__ = ("cm_counts", "years", "crops", "keys", "values")
+
+    def __init__(self, cm_counts, years, crops, keys, values):
+        self.cm_counts = cm_counts
+        self.years = years
+        self.crops = crops
+        self.keys = keys
+        self.values = values
+
+    @classmethod
+    def decode(cls, msg, output_keys, split_single_lists=True, daily_by_date=False):
+        """the result of a MONICA message, the result rows are merged per cm_count like dict.update does
+        (per date in daily sections if daily_by_date), the cm_counts without a year are dropped,
+        a list value of a key becomes key_1, key_2, ... (just key for one value, if not split_single_lists)"""
+        cm_count_to_vals = {}
+        for data in msg.get("data", []):
+            by_date = daily_by_date and data.get("origSpec", "") == '"daily"'
+            for vals in data.get("results", []):
+                if "CM-count" in vals:
+                    cm_count = vals["CM-count"]
+                elif by_date and "Date" in vals:
+                    cm_count = vals["Date"]
+                else:
+                    continue
+                if cm_count in cm_count_to_vals:
+                    cm_count_to_vals[cm_count].update(vals)
+                else:
+                    cm_count_to_vals[cm_count] = dict(vals)
+
+        cm_counts = [cm_count for cm_count, vals in cm_count_to_vals.items() if "Year" in vals]
+        rows = [cm_count_to_vals[cm_count] for cm_count in cm_counts]
+        keys = tuple(output_keys)
+        try:
+            values = np.array([[vals.get(key, np.nan) for vals in rows] for key in keys], dtype=np.float64)
+        except (TypeError, ValueError):
+            # some values are lists
+            key_to_column = {key: [np.nan] * len(rows) for key in keys}
+            for i, vals in enumerate(rows):
+                for key in output_keys:
+                    v = vals.get(key, np.nan)
+                    if not isinstance(v, list):
+                        key_to_column[key][i] = v
+                    elif len(v) == 1 and not split_single_lists:
+                        key_to_column[key][i] = v[0]
+                    else:
+                        for j, v_ in enumerate(v):
+                            key_to_column.setdefault(f"{key}_{j + 1}", [np.nan] * len(rows))[i] = v_
+            keys = tuple(key_to_column.keys())
+            values = np.array(list(key_to_column.values()), dtype=np.float64).reshape(len(keys), len(rows))
+        return cls(cm_counts, [vals["Year"] for vals in rows], [vals.get("Crop") for vals in rows], keys, values)
+
+    @classmethod
+    def mean(cls, results):
+        """one result of the results of a cell, the mean of their values per (cm_count, year) and key"""
+        if len(results) == 1:
+            return results[0]
+        entry_to_index = {}
+        crops = []
+        keys = tuple(dict.fromkeys(key for result in results for key in result.keys))
+        for result in results:
+            for entry, crop in zip(zip(result.cm_counts, result.years), result.crops):
+                if entry not in entry_to_index:
+                    entry_to_index[entry] = len(crops)
+                    crops.append(crop)
+                elif crops[entry_to_index[entry]] is None:
+                    crops[entry_to_index[entry]] = crop
+        sums = np.zeros((len(keys), len(crops)))
+        counts = np.zeros((len(keys), len(crops)))
+        for result in results:
+            ks = [keys.index(key) for key in result.keys]
+            cols = [entry_to_index[entry] for entry in zip(result.cm_counts, result.years)]
+            present = ~np.isnan(result.values)
+            sums[np.ix_(ks, cols)] += np.where(present, result.values, 0)
+            counts[np.ix_(ks, cols)] += present
+        with np.errstate(invalid="ignore"):
+            values = sums / counts
+        entries = list(entry_to_index.keys())
+        return cls([cmc for cmc, _ in entries], [year for _, year in entries], crops, keys, values)
+
+    def to_dict(self):
+        """the values per (cm_count, year) and key, -9999 for the missing ones"""
+        values = np.where(np.isnan(self.values), -9999, self.values)
+        return {(cm_count, year): dict(zip(self.keys, values[:, i].tolist()))
+                for i, (cm_count, year) in enumerate(zip(self.cm_counts, self.years))}
+
+    def cmc_to_crop(self):
+        return {cm_count: crop for cm_count, crop in zip(self.cm_counts, self.crops) if crop is not None}
+
+
+def aggregate_row(results, cols, no_of_cols, cmc_to_crop):
+    """the rows {(cm_count, year): {key: row array}} of the cell results (see CellResult) at cols (index within the
+    row, ascending), the cells without the (cm_count, year) and the missing values are -9999,
+    the first crop of a cm_count is set in cmc_to_crop"""
+    if not results:
+        return {}
+    keys = tuple(dict.fromkeys(key for result in results for key in result.keys))
+    entry_to_group = {}
+    groups = []
+    entry_cols = []
+    values = []
+    for col, result in zip(cols, results):
+        for cm_count, year, crop in zip(result.cm_counts, result.years, result.crops):
+            if cm_count not in cmc_to_crop and crop is not None:
+                cmc_to_crop[cm_count] = crop
+            groups.append(entry_to_group.setdefault((cm_count, year), len(entry_to_group)))
+            entry_cols.append(col)
+        if result.keys == keys:
+            values.append(result.values)
+        else:
+            values_ = np.full((len(keys), len(result.cm_counts)), np.nan)
+            values_[[keys.index(key) for key in result.keys]] = result.values
+            values.append(values_)
+    groups = np.array(groups, dtype=np.int64)
+    entry_cols = np.array(entry_cols, dtype=np.int64)
+    values = np.concatenate(values, axis=1)
+    values[np.isnan(values)] = -9999
+    rows = {}
+    for entry, group in entry_to_group.items():
+        in_group = groups == group
+        row_arrs = np.full((len(keys), no_of_cols), -9999.0)
+        row_arrs[:, entry_cols[in_group]] = values[:, in_group]
+        rows[entry] = dict(zip(keys, row_arrs))
+    return rows
+
+def format_grid_row(row_arr, cast_to, digits):
+    """the .asc line (without newline) of a grid row, the same text as formatting the values one by one with
+    "-9999" if int(x) == -9999 else str(int(x)) (cast_to int) or str(round(x, digits)), but done on the whole row"""
+    row_arr = np.asarray(row_arr, dtype=np.float64)
+    if cast_to == "int":
+        strs = list(map(str, row_arr.astype(np.int64).tolist()))
+    else:
+        # round of a numpy float is np.round, repr of a python float is the same shortest text as str of it
+        strs = list(map(repr, np.round(row_arr, digits).tolist()))
+    for col in np.flatnonzero(np.trunc(row_arr) == -9999).tolist():
+        strs[col] = "-9999"
+    return " ".join(strs)
+
+
+@lru_cache(maxsize=None)
+def nodata_grid_line(no_of_cols):
+    """the .asc line (with newline) of a nodata row"""
+    return " ".join(["-9999"] * no_of_cols) + "\n"
+
+class MemmapGrids:
+    """the output grids of a setup as memory mapped float32 files (one per key, year and cm_count) in path_to_dir,
+    so the cells can be written in the order their results arrive, the .asc files are written from them in one pass
+    (see write_ascii), resuming reopens the grids and the cells received so far"""
+
+    def __init__(self, path_to_dir, no_of_rows, no_of_cols, resume=False):
+        self.path_to_dir = path_to_dir
+        self.shape = (no_of_rows, no_of_cols)
+        self.grids = {}
+        self.cmc_to_crop = {}
+        os.makedirs(path_to_dir, exist_ok=True)
+        path_to_index = path_to_dir + "grids.json"
+        resume = resume and os.path.exists(path_to_index)
+        self.received = np.memmap(path_to_dir + "received.u8", dtype=np.uint8, mode="r+" if resume else "w+",
+                                  shape=self.shape)
+        if resume:
+            with open(path_to_index) as _:
+                index = json.load(_)
+            self.cmc_to_crop = {cm_count: crop for cm_count, crop in index["crops"]}
+            for key, year, cm_count in index["grids"]:
+                self.grids[(key, year, cm_count)] = np.memmap(self._path(key, year, cm_count), dtype=np.float32,
+                                                              mode="r+", shape=self.shape)
+        self.no_of_received = int(np.count_nonzero(self.received))
+
+    def _path(self, key, year, cm_count):
+        return f"{self.path_to_dir}{key}_{year}_{cm_count}.f32"
+
+    def _save_index(self):
+        with open(self.path_to_dir + "grids.json", "w") as _:
+            json.dump({"grids": list(self.grids), "crops": list(self.cmc_to_crop.items())}, _)
+
+    def grid(self, key, year, cm_count):
+        if (key, year, cm_count) not in self.grids:
+            grid = np.memmap(self._path(key, year, cm_count), dtype=np.float32, mode="w+", shape=self.shape)
+            grid[...] = -9999
+            self.grids[(key, year, cm_count)] = grid
+            self._save_index()
+        return self.grids[(key, year, cm_count)]
+
+    def is_received(self, row, col):
+        return bool(self.received[row, col])
+
+    def row_complete(self, row):
+        return bool(self.received[row].all())
+
+    def receive(self, row, col, no_of_cols=1):
+        """mark cells as received (nodata cells have nothing else to write), returns the number of new ones"""
+        cells = self.received[row, col:col + no_of_cols]
+        new = no_of_cols - int(np.count_nonzero(cells))
+        cells[...] = 1
+        self.no_of_received += new
+        return new
+
+    def write_cell(self, row, col, cmc_and_year_to_vals, cmc_to_crop):
+        """write the aggregated values (see aggregate_cell of the consumers) of a cell"""
+        if any(cm_count not in self.cmc_to_crop for cm_count in cmc_to_crop):
+            self.cmc_to_crop = {**cmc_to_crop, **self.cmc_to_crop}
+            self._save_index()
+        for (cm_count, year), key_to_val in cmc_and_year_to_vals.items():
+            for key, val in key_to_val.items():
+                self.grid(key, year, cm_count)[row, col] = val
+        return self.receive(row, col)
+
+    def copy_cell(self, row, col, env_row, env_col):
+        """the cell gets the values of the cell its identical env was sent for"""
+        for grid in self.grids.values():
+            grid[row, col] = grid[env_row, env_col]
+        return self.receive(row, col)
+
+    def complete(self):
+        return self.no_of_received == self.shape[0] * self.shape[1]
+
+    def write_ascii(self, path_to_output_dir, header, grid_specs):
+        """write the .asc file of every grid row by row, formatted like write_row_to_grids does"""
+        paths = []
+        for (key, year, cm_count), grid in self.grids.items():
+            cast_to, digits = grid_specs[key] if key in grid_specs else grid_specs[key.rsplit("_", 1)[0]]
+            crop = self.cmc_to_crop.get(cm_count, "none").replace("/", "").replace(" ", "")
+            path_to_file = path_to_output_dir + crop + "_" + key + "_" + str(year) + "_" + str(cm_count) + ".asc"
+            with open(path_to_file, "w") as _:
+                _.write(header)
+                for row_arr in grid:
+                    _.write(format_grid_row(row_arr, cast_to, digits) + "\n")
+            paths.append(path_to_file)
+        return paths
+
+    def flush(self):
+        self.received.flush()
+        for grid in self.grids.values():
+            grid.flush()
+
+    def remove(self):
+        """delete the memory mapped files, after the .asc files have been written"""
+        self.received = None
+        for path_to_file in [self._path(*key) for key in self.grids] \
+                + [self.path_to_dir + "received.u8", self.path_to_dir + "grids.json"]:
+            if os.path.exists(path_to_file):
+                os.remove(path_to_file)
+        self.grids = {}
+        if not os.listdir(self.path_to_dir):
+            os.rmdir(self.path_to_dir)
+
+
+class NetCDFCube:
+    """the output grids of a setup in one chunked and compressed netcdf file (CF conventions), a variable
+    (time, lat, lon) per output key and a time step per (year, cm_count), written row by row
+    by write_row_to_grids of the consumers and read with read_cube, resuming continues an existing cube"""
+
+    def __init__(self, path_to_cube, grid_specs, custom_id, resume=False):
+        self.path = path_to_cube
+        self.grid_specs = grid_specs
+        self.row_0 = custom_id["s_row_0"]
+        self.col_0 = custom_id["s_col_0"]
+        no_of_rows = custom_id["no_of_s_rows"]
+        no_of_cols = custom_id["no_of_s_cols"]
+        self.chunksizes = (1, min(no_of_rows, 32), no_of_cols)
+        if resume and os.path.exists(path_to_cube):
+            self.ds = Dataset(path_to_cube, "a")
+            self.year_and_cmc_to_time = {(int(year), int(cm_count)): t for t, (year, cm_count)
+                                         in enumerate(zip(self.ds["year"][:], self.ds["cm_count"][:]))}
+            return
+        self.year_and_cmc_to_time = {}
+        self.ds = ds = Dataset(path_to_cube, "w", format="NETCDF4")
+        ds.Conventions = "CF-1.8"
+        ds.title = f"MONICA output grids of setup {custom_id['setup_id']}"
+        ds.history = time.strftime("%Y-%m-%d %H:%M:%S") + " created by the consumer"
+        # the header of the .asc files, the corner is the lower left one of the grid
+        ds.ncols = no_of_cols
+        ds.nrows = no_of_rows
+        ds.xllcorner = custom_id["b_lon_0"]
+        ds.yllcorner = custom_id["b_lat_0"] - (no_of_rows * custom_id["s_resolution"])
+        ds.cellsize = custom_id["s_resolution"]
+        ds.createDimension("time", None)
+        ds.createDimension("lat", no_of_rows)
+        ds.createDimension("lon", no_of_cols)
+        lat = ds.createVariable("lat", "f8", ("lat",))
+        lat.standard_name = "latitude"
+        lat.units = "degrees_north"
+        lat[:] = ds.yllcorner + (no_of_rows - np.arange(no_of_rows) - 0.5) * ds.cellsize
+        lon = ds.createVariable("lon", "f8", ("lon",))
+        lon.standard_name = "longitude"
+        lon.units = "degrees_east"
+        lon[:] = ds.xllcorner + (np.arange(no_of_cols) + 0.5) * ds.cellsize
+        crs = ds.createVariable("crs", "i4")
+        crs.grid_mapping_name = "latitude_longitude"
+        year = ds.createVariable("year", "i4", ("time",))
+        year.long_name = "year of the crop season"
+        cm_count = ds.createVariable("cm_count", "i4", ("time",))
+        cm_count.long_name = "count of the cultivation method in the crop rotation"
+        crop = ds.createVariable("crop", str, ("time",))
+        crop.long_name = "crop of the cultivation method"
+
+    def _var(self, key):
+        if key not in self.ds.variables:
+            cast_to, _ = self.grid_specs[key] if key in self.grid_specs else self.grid_specs[key.rsplit("_", 1)[0]]
+            var = self.ds.createVariable(key, "i4" if cast_to == "int" else "f4", ("time", "lat", "lon"),
+                                         zlib=True, complevel=4, chunksizes=self.chunksizes, fill_value=-9999)
+            var.long_name = key
+            var.grid_mapping = "crs"
+            var.coordinates = "year cm_count crop"
+        return self.ds[key]
+
+    def _time(self, year, cm_count, crop):
+        t = self.year_and_cmc_to_time.get((year, cm_count))
+        if t is None:
+            t = self.year_and_cmc_to_time[(year, cm_count)] = len(self.year_and_cmc_to_time)
+            self.ds["year"][t] = year
+            self.ds["cm_count"][t] = cm_count
+            self.ds["crop"][t] = crop
+        elif crop != "none" and self.ds["crop"][t] == "none":
+            self.ds["crop"][t] = crop
+        return t
+
+    def write_row(self, key, year, cm_count, crop, row, row_arr):
+        self._var(key)[self._time(year, cm_count, crop), row - self.row_0, :] = row_arr
+
+    def sync(self):
+        self.ds.sync()
+
+    def close(self):
+        self.ds.close()
+
+
+def read_cube(path_to_cube, keys=None, years=None, crops=None, cm_counts=None):
+    """the grids (key, time, lat, lon) of a cube written by NetCDFCube, nodata as nan, only the given keys
+    (default all) and the time steps of the years (first, last), the crops and the cm_counts (first, last)
+    are read from the file"""
+    with Dataset(path_to_cube, "r") as ds:
+        keys = keys or [name for name, var in ds.variables.items() if var.dimensions == ("time", "lat", "lon")]
+        year = ds["year"][:]
+        selected = np.ones(len(year), dtype=bool)
+        if years:
+            selected &= (year >= years[0]) & (year <= years[1])
+        if cm_counts:
+            cm_count = ds["cm_count"][:]
+            selected &= (cm_count >= cm_counts[0]) & (cm_count <= cm_counts[1])
+        if crops:
+            selected &= np.isin(np.asarray(ds["crop"][:], dtype=object), list(crops))
+        ts = np.flatnonzero(selected)
+        grids = np.full((len(keys), len(ts), ds.nrows, ds.ncols), np.nan, dtype=np.float32)
+        if len(ts) > 0:
+            for i, key in enumerate(keys):
+                grids[i] = np.ma.filled(ds[key][ts, :, :].astype(np.float32), np.nan)
+        return {
+            "grids": grids,
+            "keys": keys,
+            "years": year[ts].tolist(),
+            "cm_counts": ds["cm_count"][ts].tolist() if len(ts) > 0 else [],
+            "crops": ds["crop"][ts].tolist() if len(ts) > 0 else [],
+            "lat": ds["lat"][:],
+            "lon": ds["lon"][:],
+            "header": {attr: ds.getncattr(attr) for attr in ("ncols", "nrows", "xllcorner", "yllcorner", "cellsize")},
+        }